@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+providers = {
+    "cerebras": "https://api.cerebras.ai/v1/models",
+    "groq": "https://api.groq.com/openai/v1/models",
+    "openrouter": "https://openrouter.ai/api/v1/models",
+}
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "60")),
+    )
+
+
+async def cold_request(url: str, verify: bool, http2: bool) -> float:
+    started = time.perf_counter()
+    async with httpx.AsyncClient(verify=verify, http2=http2) as client:
+        await client.get(url)
+    return time.perf_counter() - started
+
+
+async def pooled_request(client: httpx.AsyncClient, url: str) -> float:
+    started = time.perf_counter()
+    await client.get(url)
+    return time.perf_counter() - started
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def report(label: str, samples, wall: float):
+    print(
+        f"  {label:>7}: p50 {percentile(samples, 0.5) * 1000:7.1f}ms, "
+        f"p95 {percentile(samples, 0.95) * 1000:7.1f}ms, "
+        f"mean {statistics.mean(samples) * 1000:7.1f}ms, wall {wall:.2f}s"
+    )
+
+
+async def run_batches(fn, requests: int, concurrency: int):
+    samples = []
+    started = time.perf_counter()
+    for _ in range(0, requests, concurrency):
+        samples.extend(await asyncio.gather(*(fn() for _ in range(concurrency))))
+    return samples, time.perf_counter() - started
+
+
+async def bench(url: str, requests: int, concurrency: int, verify: bool, http2: bool):
+    cold, cold_wall = await run_batches(
+        lambda: cold_request(url, verify, http2), requests, concurrency
+    )
+    async with httpx.AsyncClient(
+        verify=verify, http2=http2, limits=pool_limits()
+    ) as client:
+        await client.get(url)
+        pooled, pooled_wall = await run_batches(
+            lambda: pooled_request(client, url), requests, concurrency
+        )
+        version = (await client.get(url)).http_version
+    print(f"{url} ({version}, concurrency {concurrency})")
+    report("cold", cold, cold_wall)
+    report("pooled", pooled, pooled_wall)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Задержка запроса с новым соединением на каждый вызов и через общий пул"
+    )
+    parser.add_argument(
+        "urls", nargs="*", help="URL для замера (по умолчанию /models провайдеров)"
+    )
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--http1", action="store_true", help="без HTTP/2")
+    parser.add_argument(
+        "--insecure", action="store_true", help="не проверять TLS (локальный стенд)"
+    )
+    args = parser.parse_args()
+
+    for url in args.urls or providers.values():
+        try:
+            asyncio.run(
+                bench(
+                    url,
+                    args.requests,
+                    args.concurrency,
+                    not args.insecure,
+                    not args.http1,
+                )
+            )
+        except httpx.HTTPError as e:
+            print(f"{url}: {e!r}")
+
+
+if __name__ == "__main__":
+    main()
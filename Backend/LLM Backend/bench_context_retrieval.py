@@ -0,0 +1,60 @@
+import argparse
+import random
+import statistics
+import time
+
+from context_retrieval import BM25Index, message_terms
+
+vocabulary = (
+    "проект бюджет сервер база данных кошка собака отпуск билет поезд самолёт "
+    "рецепт борщ python fastapi docker деплой ошибка логи метрики отчёт встреча "
+    "договор оплата счёт клиент задача релиз тест кеш очередь память процессор "
+    "weather price release deploy invoice meeting travel recipe error cache"
+).split()
+
+
+def make_messages(count: int, words: int, seed: int):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(vocabulary) for _ in range(rng.randint(words // 2, words)))
+        + f" сообщение {i}"
+        for i in range(count)
+    ]
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return result, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Время построения BM25-индекса и запроса по истории чата"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--words", type=int, default=60, help="слов в сообщении")
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    query = "какой был бюджет проекта и когда релиз на сервер"
+    for size in args.sizes:
+        contents = make_messages(size, args.words, seed=size)
+        message_terms.cache_clear()
+        _, cold = timed(lambda: BM25Index(contents), 1)
+        index, warm = timed(lambda: BM25Index(contents), args.repeat)
+        top, query_time = timed(lambda: index.top_k(query, args.top_k), args.repeat)
+        print(
+            f"{size:>6} messages: build cold {cold * 1000:.1f}ms, "
+            f"build cached {warm * 1000:.1f}ms, query {query_time * 1000:.2f}ms, "
+            f"top-{args.top_k}: {top}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+from bench_mock_upstream import (
+    completion_body,
+    install_upstream,
+    latency_line,
+    load_main,
+)
+
+
+async def run_mode(main, hedge: bool, args, rng: random.Random):
+    main.latency_tracker = main.LatencyTracker()
+    main.hedge_policy = main.HedgePolicy()
+
+    async def upstream(request: httpx.Request):
+        delay = max(0.0, rng.gauss(args.base, args.jitter))
+        if rng.random() < args.stall_rate:
+            delay = args.stall
+        await asyncio.sleep(delay)
+        return httpx.Response(200, json=completion_body())
+
+    install_upstream(main, upstream)
+    counter = iter(range(10**9))
+
+    async def ask(hedged: bool) -> float:
+        request = main.LLMRequest(
+            prompt=[{"role": "user", "content": f"вопрос {next(counter)}"}],
+            model=args.model,
+            provider=[args.provider],
+            hedge=hedged,
+            cache=False,
+        )
+        started = time.perf_counter()
+        response = await main.providerRouting(request)
+        if response.status_code != 200:
+            raise RuntimeError(response.body)
+        return time.perf_counter() - started
+
+    for _ in range(0, args.warmup, args.concurrency):
+        await asyncio.gather(*(ask(False) for _ in range(args.concurrency)))
+
+    fired = main.metrics._counters.get("hedge_fired_total", 0)
+    won = main.metrics._counters.get("hedge_won_total", 0)
+    samples = []
+    for _ in range(0, args.requests, args.concurrency):
+        samples.extend(
+            await asyncio.gather(*(ask(hedge) for _ in range(args.concurrency)))
+        )
+    fired = main.metrics._counters.get("hedge_fired_total", 0) - fired
+    won = main.metrics._counters.get("hedge_won_total", 0) - won
+    return samples, int(fired), int(won)
+
+
+async def bench(args):
+    main = load_main()
+    for hedge in (False, True):
+        samples, fired, won = await run_mode(
+            main, hedge, args, random.Random(args.seed)
+        )
+        line = latency_line("hedging on" if hedge else "hedging off", samples)
+        if hedge:
+            line += f", hedges {fired}/{len(samples)}, won {won}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="p50/p95/p99 /llm с хеджированием и без на моке провайдера с задержками"
+    )
+    parser.add_argument("--requests", type=int, default=80)
+    parser.add_argument("--warmup", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--base", type=float, default=0.05, help="обычная задержка, с")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--stall-rate", type=float, default=0.05)
+    parser.add_argument(
+        "--stall", type=float, default=2.0, help="задержка зависания, с"
+    )
+    parser.add_argument("--provider", default="cerebras")
+    parser.add_argument("--model", default="cerebras/llama-3.3-70b")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import statistics
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+fake_keys = (
+    "CEREBRAS_API_KEY_1",
+    "CEREBRAS_API_KEY_2",
+    "CEREBRAS_API_KEY_3",
+    "GROQ_API_KEY_1",
+    "GROQ_API_KEY_2",
+    "MEM0_API_KEY",
+)
+
+
+class OfflineMemoryClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def search(self, *args, **kwargs):
+        return []
+
+    async def add(self, *args, **kwargs):
+        return {}
+
+
+def load_main():
+    for name in fake_keys:
+        os.environ.setdefault(name, f"bench-{name.lower()}")
+    import mem0
+    import sentry_sdk
+
+    mem0.AsyncMemoryClient = OfflineMemoryClient
+    sentry_sdk.init = lambda *args, **kwargs: None
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    return main
+
+
+def completion_body(
+    text: str = "ok",
+    tool_calls: Optional[List[Dict[str, Any]]] = None,
+    prompt_tokens: int = 10,
+) -> Dict[str, Any]:
+    message: Dict[str, Any] = {"role": "assistant", "content": text}
+    if tool_calls:
+        message["content"] = None
+        message["tool_calls"] = [
+            {
+                "id": f"call_{i}",
+                "type": "function",
+                "function": {"name": c["name"], "arguments": c["arguments"]},
+            }
+            for i, c in enumerate(tool_calls)
+        ]
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "bench",
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tool_calls else "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": 2,
+            "total_tokens": prompt_tokens + 2,
+        },
+    }
+
+
+def install_upstream(main, handler: Callable, names=None):
+    async def transport(request: httpx.Request):
+        response = handler(request)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    for name in names or main.providers:
+        main.client_registry._http[name] = httpx.AsyncClient(
+            transport=httpx.MockTransport(transport)
+        )
+    main.client_registry._openai.clear()
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def latency_line(label: str, samples) -> str:
+    return (
+        f"{label:>12}: p50 {percentile(samples, 0.5) * 1000:7.1f}ms, "
+        f"p95 {percentile(samples, 0.95) * 1000:7.1f}ms, "
+        f"p99 {percentile(samples, 0.99) * 1000:7.1f}ms, "
+        f"mean {statistics.mean(samples) * 1000:7.1f}ms"
+    )
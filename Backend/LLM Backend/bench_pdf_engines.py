@@ -0,0 +1,115 @@
+import argparse
+import os
+import statistics
+import time
+
+from file_extraction import as_file, pdf_bytes_to_text, pdf_engines
+
+line_text = (
+    "Lorem ipsum dolor sit amet, page {page} line {line}, consectetur adipiscing elit"
+)
+
+
+def make_pdf(pages: int, lines: int = 40) -> bytes:
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>", None]
+    kids = []
+    for page in range(pages):
+        shows = " ".join(
+            "(%s) '" % line_text.format(page=page, line=line) for line in range(lines)
+        )
+        stream = f"BT /F1 10 Tf 40 800 Td 12 TL {shows} ET".encode()
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 1 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids),
+        pages,
+    )
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        len(objects),
+        xref,
+    )
+    return bytes(out)
+
+
+def load_corpus(paths, generate):
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.lower().endswith(".pdf"))
+            paths.extend(os.path.join(path, n) for n in names)
+            continue
+        with open(path, "rb") as f:
+            corpus.append((os.path.basename(path), f.read()))
+    for pages in generate:
+        corpus.append((f"generated-{pages}p.pdf", make_pdf(pages)))
+    return corpus
+
+
+def parse_all(engine: str, data: bytes):
+    pages = 0
+    chars = 0
+    for text in pdf_engines[engine](as_file(data), 0):
+        pages += 1
+        chars += len(text)
+    return pages, chars
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return result, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Скорость извлечения текста из PDF (страниц/с) по движкам"
+    )
+    parser.add_argument("paths", nargs="*", help="PDF-файлы или каталоги с ними")
+    parser.add_argument(
+        "--generate",
+        type=int,
+        nargs="*",
+        default=[50, 300],
+        help="страниц в синтетических PDF",
+    )
+    parser.add_argument("--engines", nargs="+", default=sorted(pdf_engines))
+    parser.add_argument("--max-chars", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(list(args.paths), args.generate)
+    for name, data in corpus:
+        print(f"{name}: {len(data) / 1024:.0f} KB")
+        for engine in args.engines:
+            (pages, chars), full = timed(lambda: parse_all(engine, data), args.repeat)
+            _, budget = timed(
+                lambda: pdf_bytes_to_text(data, args.max_chars, engine), args.repeat
+            )
+            print(
+                f"  {engine:>16}: {pages / full:7.1f} pages/s ({pages} pages, {chars} chars), "
+                f"first {args.max_chars} chars in {budget * 1000:.0f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
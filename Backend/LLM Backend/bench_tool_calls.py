@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+from bench_mock_upstream import completion_body, install_upstream, load_main
+
+tool_arguments = {
+    "web_search": {"query": "курс евро сегодня"},
+    "search_memory": {"query": "город пользователя"},
+    "science_search": {"query": "distance from Moscow to Paris"},
+    "python_code_execution": {"code": "sum(range(10))"},
+}
+
+
+def make_upstream(tools, per_step: int, llm_latency: float, calls: list):
+    async def upstream(request: httpx.Request):
+        calls.append(time.perf_counter())
+        await asyncio.sleep(llm_latency)
+        messages = json.loads(request.content)["messages"]
+        answered = sum(1 for m in messages if m.get("role") == "tool")
+        pending = tools[answered : answered + per_step]
+        if not pending:
+            return httpx.Response(200, json=completion_body("Готово"))
+        return httpx.Response(
+            200,
+            json=completion_body(
+                tool_calls=[
+                    {"name": name, "arguments": json.dumps(tool_arguments[name])}
+                    for name in pending
+                ]
+            ),
+        )
+
+    return upstream
+
+
+def fake_tool(name: str, latency: float):
+    async def tool(**kwargs):
+        await asyncio.sleep(latency)
+        return {"tool": name, "result": f"ответ {name}"}
+
+    return tool
+
+
+async def bench(args):
+    main = load_main()
+    for name in args.tools:
+        main.available_functions[name] = fake_tool(name, args.tool_latency)
+
+    modes = [("one tool per step", 1), ("all tools in one step", len(args.tools))]
+    for label, per_step in modes:
+        walls = []
+        trips = []
+        for _ in range(args.repeat):
+            calls = []
+            install_upstream(
+                main,
+                make_upstream(args.tools, per_step, args.llm_latency, calls),
+            )
+            started = time.perf_counter()
+            result = await main.run_agent(
+                [
+                    {"role": "system", "content": "Ты помощник."},
+                    {"role": "user", "content": "Найди всё и посчитай."},
+                ]
+            )
+            walls.append(time.perf_counter() - started)
+            trips.append(len(calls))
+            assert result["final_content"] == "Готово", result
+        print(
+            f"{label:>22}: {statistics.median(trips):.0f} LLM round trips, "
+            f"wall {statistics.median(walls) * 1000:.0f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Число обращений к модели и время шага агента с несколькими инструментами"
+    )
+    parser.add_argument(
+        "--tools",
+        nargs="+",
+        default=["web_search", "search_memory", "science_search"],
+        choices=sorted(tool_arguments),
+    )
+    parser.add_argument("--tool-latency", type=float, default=0.3)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import json
+import os
+
+samples_path = os.path.join(os.path.dirname(__file__), "tool_output_samples.jsonl")
+
+
+def load_samples(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report(main, samples, tokens):
+    total_before = 0
+    total_after = 0
+    for sample in samples:
+        tool = sample["tool"]
+        before = tokens(json.dumps(sample["output"], default=str))
+        after = tokens(main.reduce_tool_output(tool, sample["output"]))
+        total_before += before
+        total_after += after
+        query = json.dumps(sample.get("args", {}), ensure_ascii=False)
+        print(
+            f"{tool:>15} {sample.get('source', 'synthetic'):>9}: "
+            f"{before:6d} -> {after:5d} tokens ({1 - after / before:4.0%}) {query}"
+        )
+    print(
+        f"{'total':>25}: {total_before:6d} -> {total_after:5d} tokens "
+        f"({1 - total_after / total_before:4.0%})"
+    )
+
+
+async def record(main, tool: str, arguments: dict, path: str):
+    output = await main.available_functions[tool](**arguments)
+    with open(path, "a", encoding="utf-8") as f:
+        sample = {"tool": tool, "args": arguments, "source": "recorded"}
+        sample["output"] = output
+        f.write(json.dumps(sample, ensure_ascii=False, default=str) + "\n")
+    print(f"{tool}: записано в {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Токены ответа инструмента в промпте до и после редьюсеров"
+    )
+    parser.add_argument("--samples", default=samples_path)
+    parser.add_argument(
+        "--tokenizer",
+        choices=["estimate", "raw"],
+        default="raw",
+        help="estimate — estimate_tokens_from_text, raw — raw_token_estimate",
+    )
+    parser.add_argument(
+        "--record",
+        nargs=2,
+        metavar=("TOOL", "ARGS_JSON"),
+        help="вызвать настоящий инструмент (ключи из .env) и дописать ответ в выборку",
+    )
+    args = parser.parse_args()
+
+    if args.record:
+        import main as app
+
+        tool, arguments = args.record
+        asyncio.run(record(app, tool, json.loads(arguments), args.samples))
+        return
+
+    from bench_mock_upstream import load_main
+
+    app = load_main()
+    tokens = (
+        app.raw_token_estimate
+        if args.tokenizer == "raw"
+        else app.estimate_tokens_from_text
+    )
+    report(app, load_samples(args.samples), tokens)
+
+
+if __name__ == "__main__":
+    main()
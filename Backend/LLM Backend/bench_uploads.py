@@ -0,0 +1,96 @@
+import argparse
+import base64
+import os
+import statistics
+import time
+
+import httpx
+
+
+def make_text_file(path: str, size_mb: int):
+    line = "Строка тестового файла для замера загрузки, line of the upload benchmark.\n"
+    data = line.encode("utf-8")
+    with open(path, "wb") as f:
+        for _ in range(size_mb * 1024 * 1024 // len(data) + 1):
+            f.write(data)
+
+
+def reset_peak_rss(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def send(client: httpx.Client, url: str, mode: str, path: str, name: str):
+    if mode == "json":
+        with open(path, "rb") as f:
+            buffer = base64.b64encode(f.read()).decode("ascii")
+        return client.post(
+            f"{url}/files", json={"buffer": buffer, "name": name, "mime": ""}
+        )
+    if mode == "raw":
+        with open(path, "rb") as f:
+            return client.post(
+                f"{url}/files/upload",
+                params={"name": name},
+                content=f,
+                headers={"content-type": "application/octet-stream"},
+            )
+    with open(path, "rb") as f:
+        return client.post(f"{url}/files/upload", files={"file": (name, f)})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Задержка и пиковый RSS сервера при загрузке файлов в /files"
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--file", help="файл для загрузки (по умолчанию txt)")
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--pid", type=int, help="pid сервера для замера RSS")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", default=["json", "raw", "multipart"])
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        path = f"/tmp/bench_upload_{args.size_mb}mb.txt"
+        if not os.path.exists(path):
+            make_text_file(path, args.size_mb)
+    name = os.path.basename(path)
+    print(f"{name}: {os.path.getsize(path) / 1024 / 1024:.1f} MB")
+
+    with httpx.Client(timeout=300) as client:
+        for mode in args.modes:
+            samples = []
+            peaks = []
+            for i in range(args.repeat):
+                if args.pid and reset_peak_rss(args.pid):
+                    before = peak_rss_mb(args.pid)
+                else:
+                    before = None
+                started = time.perf_counter()
+                resp = send(client, args.url, mode, path, f"{i}-{name}")
+                samples.append(time.perf_counter() - started)
+                resp.raise_for_status()
+                if before is not None:
+                    peaks.append(peak_rss_mb(args.pid) - before)
+            line = f"{mode:>9}: median {statistics.median(samples) * 1000:.0f}ms"
+            if peaks:
+                line += f", peak RSS +{max(peaks):.0f} MB"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
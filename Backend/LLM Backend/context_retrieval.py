@@ -0,0 +1,80 @@
+import functools
+import os
+import re
+from collections import Counter
+from typing import List, Sequence
+
+import numpy as np
+
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "50000"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+STEM_LENGTH = 5
+
+word_re = re.compile(r"\w+", re.UNICODE)
+
+
+def stems(text: str) -> List[str]:
+    return [w[:STEM_LENGTH] for w in word_re.findall(text.lower()) if len(w) > 2]
+
+
+def term_id(stem: str) -> int:
+    return hash(stem) & 0x7FFFFFFFFFFFFFFF
+
+
+@functools.lru_cache(maxsize=RETRIEVAL_CACHE_SIZE)
+def message_terms(content: str) -> tuple:
+    words = stems(content)
+    if not words:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), 0
+    counter = Counter(words)
+    ids = np.fromiter(map(term_id, counter), dtype=np.int64, count=len(counter))
+    counts = np.fromiter(counter.values(), dtype=np.float32, count=len(counter))
+    return ids, counts, len(words)
+
+
+class BM25Index:
+    def __init__(self, contents: Sequence[str]):
+        terms = [message_terms(c) for c in contents]
+        self.size = len(terms)
+        self.lengths = np.fromiter(
+            (t[2] for t in terms), dtype=np.float32, count=self.size
+        )
+        self.avgdl = float(self.lengths.mean()) if self.size else 0.0
+        sizes = np.fromiter((len(t[0]) for t in terms), dtype=np.int64, count=self.size)
+        if self.size:
+            self.ids = np.concatenate([t[0] for t in terms])
+            self.tf = np.concatenate([t[1] for t in terms])
+        else:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.tf = np.empty(0, dtype=np.float32)
+        self.doc = np.repeat(np.arange(self.size), sizes)
+
+    def scores(self, query: str) -> np.ndarray:
+        out = np.zeros(self.size, dtype=np.float64)
+        words = stems(query)
+        if not words or not self.size or self.avgdl == 0:
+            return out
+        q = np.unique(np.fromiter((term_id(w) for w in words), dtype=np.int64))
+        mask = np.isin(self.ids, q)
+        if not mask.any():
+            return out
+        ids, tf, doc = self.ids[mask], self.tf[mask], self.doc[mask]
+        pos = np.searchsorted(q, ids)
+        df = np.bincount(pos, minlength=len(q))
+        idf = np.log1p((self.size - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc] / self.avgdl)
+        weights = idf[pos] * tf * (BM25_K1 + 1) / (tf + norm)
+        return np.bincount(doc, weights=weights, minlength=self.size)
+
+    def top_k(self, query: str, k: int) -> List[int]:
+        scores = self.scores(query)
+        if k <= 0 or not scores.any():
+            return []
+        k = min(k, int(np.count_nonzero(scores)))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(i) for i in top[np.argsort(-scores[top], kind="stable")]]
+
+
+def relevant_messages(contents: Sequence[str], query: str, k: int) -> List[int]:
+    return BM25Index(contents).top_k(query, k)
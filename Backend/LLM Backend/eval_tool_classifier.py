@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import functools
+import json
+import time
+
+import tool_classifier
+from tool_classifier import (
+    TOOL_CLASSIFIER_MODEL,
+    TOOL_CLASSIFIER_THRESHOLD,
+    tool_need_score,
+)
+
+
+def load_prompts(path: str):
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                items.append(json.loads(line))
+    return items
+
+
+async def measure_saved(items, threshold: float, model: str, step_seconds: float):
+    import httpx
+
+    from bench_mock_upstream import completion_body, install_upstream, load_main
+
+    app = load_main()
+
+    async def agent_model(request: httpx.Request):
+        await asyncio.sleep(step_seconds)
+        return httpx.Response(200, json=completion_body("ответ агента"))
+
+    install_upstream(app, agent_model)
+    app.needs_tools = functools.partial(
+        tool_classifier.needs_tools, threshold=threshold, model_path=model
+    )
+    walls = {}
+    for enabled in (False, True):
+        app.TOOL_CLASSIFIER_ENABLED = enabled
+        started = time.perf_counter()
+        for item in items:
+            await app.prepare_provider_request(
+                app.LLMRequest(
+                    prompt=[{"role": "user", "content": item["prompt"]}],
+                    model="cerebras/llama-3.3-70b",
+                    provider=["cerebras"],
+                    is_agent=True,
+                    agent_mode="separate",
+                )
+            )
+        walls[enabled] = time.perf_counter() - started
+    total = max(len(items), 1)
+    print(
+        f"measured, agent step {step_seconds:g}s: classifier off {walls[False]:.2f}s, "
+        f"on {walls[True]:.2f}s, saved {walls[False] - walls[True]:.2f}s total, "
+        f"~{(walls[False] - walls[True]) / total * 1000:.0f}ms per request"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Оценка пред-классификатора необходимости инструментов"
+    )
+    parser.add_argument("prompts", help="jsonl с полями prompt и needs_tools")
+    parser.add_argument("--threshold", type=float, default=TOOL_CLASSIFIER_THRESHOLD)
+    parser.add_argument("--model", default=TOOL_CLASSIFIER_MODEL)
+    parser.add_argument(
+        "--agent-step-seconds",
+        type=float,
+        default=1.2,
+        help="средняя длительность одного шага агента (qwen-3-32b)",
+    )
+    parser.add_argument(
+        "--measure",
+        action="store_true",
+        help="замерить экономию на prepare_provider_request с моком модели агента",
+    )
+    args = parser.parse_args()
+
+    items = load_prompts(args.prompts)
+    tp = fp = tn = fn = 0
+    false_negatives = []
+    started = time.perf_counter()
+    for item in items:
+        messages = [{"role": "user", "content": item["prompt"]}]
+        predicted = tool_need_score(messages, args.model) >= args.threshold
+        actual = bool(item["needs_tools"])
+        if predicted and actual:
+            tp += 1
+        elif predicted and not actual:
+            fp += 1
+        elif not predicted and actual:
+            fn += 1
+            false_negatives.append(item["prompt"])
+        else:
+            tn += 1
+    elapsed = time.perf_counter() - started
+
+    total = len(items)
+    skipped = tn + fn
+    print(f"prompts: {total}, threshold: {args.threshold}")
+    print(f"tp={tp} fp={fp} tn={tn} fn={fn}")
+    if total:
+        print(f"false negative rate: {fn / max(tp + fn, 1):.1%}")
+        print(f"agent loop skipped: {skipped / total:.1%}")
+        print(
+            f"latency saved (estimate): ~{skipped * args.agent_step_seconds:.1f}s total, "
+            f"~{skipped * args.agent_step_seconds / total:.2f}s per request"
+        )
+        print(f"classifier cost: {elapsed / total * 1e6:.1f}µs per prompt")
+    for p in false_negatives:
+        print(f"  missed: {p}")
+    if args.measure:
+        asyncio.run(
+            measure_saved(items, args.threshold, args.model, args.agent_step_seconds)
+        )
+
+
+if __name__ == "__main__":
+    main()
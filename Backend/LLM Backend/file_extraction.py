@@ -0,0 +1,572 @@
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import re
+from html.parser import HTMLParser
+from io import BytesIO
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import xlrd
+from openpyxl import load_workbook
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfdevice import PDFTextDevice
+from pdfminer.pdffont import PDFUnicodeNotDefined
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+
+try:
+    from docx import Document
+except Exception as e:
+    Document = None
+
+try:
+    import pypdfium2 as pdfium
+except Exception as e:
+    pdfium = None
+
+media_types = {
+    "pdf": "pdf",
+    "xls": "table",
+    "xlsx": "table",
+    "csv": "table",
+    "txt": "text",
+    "md": "text",
+    "json": "json",
+    "html": "html",
+    "htm": "html",
+    "docx": "document",
+}
+
+TABLE_SAMPLE_ROWS = 5
+TABLE_SCHEMA_SCAN_ROWS = 200
+CSV_SNIFF_BYTES = 64 * 1024
+PDF_MAX_PAGES = int(os.getenv("EXTRACT_PDF_MAX_PAGES", "300"))
+XLS_MAX_BYTES = int(os.getenv("EXTRACT_XLS_MAX_BYTES", str(10 * 1024 * 1024)))
+
+number_re = re.compile(r"[-+]?\d+([.,]\d+)?([eE][-+]?\d+)?")
+date_re = re.compile(r"\d{4}-\d{2}-\d{2}([ T][\d:.]+)?|\d{2}\.\d{2}\.\d{4}( [\d:]+)?")
+
+
+def try_decode(b) -> str:
+    for enc in ("utf-8", "cp1251", "latin1"):
+        try:
+            return str(b, enc)
+        except Exception:
+            pass
+    return str(b, "utf-8", errors="ignore")
+
+
+def decode_prefix(b, max_chars: Optional[int]) -> str:
+    if max_chars is None or len(b) <= max_chars * 4:
+        return try_decode(b)
+    head = memoryview(b)[: max_chars * 4]
+    try:
+        return str(head, "utf-8")
+    except UnicodeDecodeError as e:
+        if e.start >= len(head) - 3:
+            return str(head[: e.start], "utf-8")
+    return try_decode(head)
+
+
+def as_file(source):
+    if hasattr(source, "read"):
+        source.seek(0)
+        return source
+    return BytesIO(source)
+
+
+def as_bytes(source):
+    if hasattr(source, "read"):
+        source.seek(0)
+        return source.read()
+    return source
+
+
+def truncate(s: str, limit: Optional[int]) -> str:
+    if limit is None:
+        return s
+    return s[:limit]
+
+
+class _HTMLTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self._texts = []
+        self._skip = False
+        self._skip_tags = {"script", "style", "noscript"}
+
+    def handle_starttag(self, tag, attrs):
+        t = tag.lower()
+        if t in self._skip_tags:
+            self._skip = True
+        if t in {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5"}:
+            self._texts.append("\n")
+
+    def handle_endtag(self, tag):
+        t = tag.lower()
+        if t in self._skip_tags:
+            self._skip = False
+        if t in {"p", "div", "li", "tr"}:
+            self._texts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._texts.append(data)
+
+    def get_text(self):
+        txt = "".join(self._texts)
+        lines = [line.strip() for line in txt.splitlines()]
+        return "\n".join([l for l in lines if l])
+
+
+def html_to_text(html_bytes: bytes) -> str:
+    parser = _HTMLTextExtractor()
+    parser.feed(try_decode(html_bytes))
+    return parser.get_text()
+
+
+def docx_bytes_to_text(b) -> str:
+
+    if Document is None:
+        raise RuntimeError("python-docx не установлен (pip install python-docx)")
+
+    doc = Document(as_file(b))
+
+    parts = []
+    for p in doc.paragraphs:
+        if p.text:
+            parts.append(p.text)
+
+    for table in doc.tables:
+        for row in table.rows:
+            row_texts = [cell.text for cell in row.cells]
+            if any(row_texts):
+                parts.append("\t".join(row_texts))
+
+    try:
+        for section in doc.sections:
+            header = section.header
+            footer = section.footer
+            for p in header.paragraphs:
+                if p.text:
+                    parts.append(p.text)
+            for p in footer.paragraphs:
+                if p.text:
+                    parts.append(p.text)
+    except Exception:
+        pass
+
+    return "\n".join(parts)
+
+
+class PlainTextDevice(PDFTextDevice):
+    def __init__(self, rsrcmgr):
+        super().__init__(rsrcmgr)
+        self.parts: List[str] = []
+        self.last = None
+
+    def begin_page(self, page, ctm):
+        super().begin_page(page, ctm)
+        self.last = None
+
+    def render_char(
+        self, matrix, font, fontsize, scaling, rise, cid, ncs, graphicstate
+    ):
+        try:
+            text = font.to_unichr(cid)
+        except PDFUnicodeNotDefined:
+            text = ""
+        adv = font.char_width(cid) * fontsize * scaling
+        a, _, _, d, x, y = matrix
+        size = abs(fontsize * d) or fontsize
+        if self.last is not None:
+            last_x, last_y = self.last
+            if abs(y - last_y) > size * 0.5:
+                self.parts.append("\n")
+            elif x - last_x > size * 0.2 and text != " ":
+                self.parts.append(" ")
+        self.last = (x + adv * a, y)
+        self.parts.append(text)
+        return adv
+
+    def pop_text(self) -> str:
+        text = "".join(self.parts) + "\n\n"
+        self.parts.clear()
+        return text
+
+
+def pdfminer_text_pages(fp, max_pages: int) -> Iterator[str]:
+    rsrcmgr = PDFResourceManager()
+    device = PlainTextDevice(rsrcmgr)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    try:
+        for page in PDFPage.get_pages(fp, maxpages=max_pages, check_extractable=False):
+            interpreter.process_page(page)
+            yield device.pop_text()
+    finally:
+        device.close()
+
+
+def pdfminer_layout_pages(fp, max_pages: int) -> Iterator[str]:
+    rsrcmgr = PDFResourceManager()
+    retstr = io.StringIO()
+    device = TextConverter(rsrcmgr, retstr, laparams=LAParams())
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    try:
+        for page in PDFPage.get_pages(fp, maxpages=max_pages, check_extractable=False):
+            interpreter.process_page(page)
+            yield retstr.getvalue()
+            retstr.truncate(0)
+            retstr.seek(0)
+    finally:
+        device.close()
+        retstr.close()
+
+
+def pdfium_pages(fp, max_pages: int) -> Iterator[str]:
+    pdf = pdfium.PdfDocument(fp)
+    try:
+        count = len(pdf) if not max_pages else min(len(pdf), max_pages)
+        for index in range(count):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                yield textpage.get_text_range() + "\n\n"
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
+
+
+pdf_engines: Dict[str, Callable[..., Iterator[str]]] = {
+    "pdfminer-text": pdfminer_text_pages,
+    "pdfminer-layout": pdfminer_layout_pages,
+}
+if pdfium is not None:
+    pdf_engines["pdfium"] = pdfium_pages
+
+PDF_FALLBACK_ENGINE = "pdfminer-layout"
+PDF_ENGINE = os.getenv("EXTRACT_PDF_ENGINE", "auto")
+if PDF_ENGINE not in pdf_engines:
+    PDF_ENGINE = "pdfium" if pdfium is not None else "pdfminer-text"
+
+
+def pdf_pages_to_text(
+    data, engine: str, max_chars: Optional[int], max_pages: int
+) -> str:
+    parts = []
+    size = 0
+    pages = pdf_engines[engine](as_file(data), max_pages)
+    with contextlib.closing(pages):
+        for page_text in pages:
+            if max_chars is not None:
+                page_text = page_text[: max_chars - size]
+            parts.append(page_text)
+            size += len(page_text)
+            if max_chars is not None and size >= max_chars:
+                break
+    return "".join(parts)
+
+
+def pdf_bytes_to_text(
+    data,
+    max_chars: Optional[int] = None,
+    engine: Optional[str] = None,
+    max_pages: int = PDF_MAX_PAGES,
+) -> str:
+    engine = engine or PDF_ENGINE
+    try:
+        return pdf_pages_to_text(data, engine, max_chars, max_pages)
+    except Exception:
+        if engine == PDF_FALLBACK_ENGINE:
+            raise
+    return pdf_pages_to_text(data, PDF_FALLBACK_ENGINE, max_chars, max_pages)
+
+
+class TextBudget:
+    def __init__(self, max_chars: Optional[int]):
+        self.max_chars = max_chars
+        self.parts: List[str] = []
+        self.size = 0
+
+    @property
+    def full(self) -> bool:
+        return self.max_chars is not None and self.size >= self.max_chars
+
+    def add(self, line: str) -> bool:
+        if self.full:
+            return False
+        if self.parts:
+            line = "\n" + line
+        if self.max_chars is not None:
+            line = line[: self.max_chars - self.size]
+        self.parts.append(line)
+        self.size += len(line)
+        return not self.full
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+def cell_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        return value.date().isoformat()
+    return str(value)
+
+
+def cell_type(value) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int) or isinstance(value, float) and value.is_integer():
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return "date"
+    text = str(value).strip()
+    match = number_re.fullmatch(text)
+    if match:
+        return "float" if match.group(1) or match.group(2) else "int"
+    if date_re.fullmatch(text):
+        return "date"
+    return "text"
+
+
+def column_type(types: set) -> str:
+    if not types:
+        return "empty"
+    if len(types) == 1:
+        return next(iter(types))
+    if types == {"int", "float"}:
+        return "float"
+    return "text"
+
+
+def row_cells(row) -> list:
+    cells = list(row)
+    while cells and (cells[-1] is None or cells[-1] == ""):
+        cells.pop()
+    return cells
+
+
+Sheet = Tuple[Optional[str], Optional[int], Iterator]
+
+
+def xlsx_sheets(source) -> Iterator[Sheet]:
+    wb = load_workbook(filename=as_file(source), read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            yield ws.title, ws.max_row, ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def xls_cell(book, cell):
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        try:
+            return xlrd.xldate_as_datetime(cell.value, book.datemode)
+        except Exception:
+            return cell.value
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(cell.value)
+    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+        return None
+    return cell.value
+
+
+def xls_sheets(source) -> Iterator[Sheet]:
+    size = os.fstat(source.fileno()).st_size if hasattr(source, "name") else len(source)
+    if size > XLS_MAX_BYTES:
+        raise ValueError(
+            f"Файл .xls больше {XLS_MAX_BYTES // (1024 * 1024)} МБ: листы старого формата "
+            "разбираются целиком, сохраните таблицу как .xlsx или .csv"
+        )
+    if hasattr(source, "name"):
+        book = xlrd.open_workbook(filename=source.name, on_demand=True)
+    else:
+        book = xlrd.open_workbook(file_contents=bytes(source), on_demand=True)
+    try:
+        for index in range(book.nsheets):
+            sheet = book.sheet_by_index(index)
+            rows = (
+                [xls_cell(book, c) for c in sheet.row(r)] for r in range(sheet.nrows)
+            )
+            yield sheet.name, sheet.nrows, rows
+            book.unload_sheet(index)
+    finally:
+        book.release_resources()
+
+
+def sniff_encoding(head: bytes) -> str:
+    try:
+        head.decode("utf-8")
+        return "utf-8-sig"
+    except UnicodeDecodeError as e:
+        if e.start >= len(head) - 3:
+            return "utf-8-sig"
+    return "cp1251"
+
+
+def csv_sheets(source) -> Iterator[Sheet]:
+    raw = as_file(source)
+    head = raw.read(CSV_SNIFF_BYTES)
+    raw.seek(0)
+    encoding = sniff_encoding(head)
+    try:
+        dialect = csv.Sniffer().sniff(
+            head.decode(encoding, errors="ignore"), delimiters=",;\t|"
+        )
+    except csv.Error:
+        dialect = csv.excel
+    text = io.TextIOWrapper(raw, encoding=encoding, errors="replace", newline="")
+    try:
+        yield None, None, csv.reader(text, dialect)
+    finally:
+        text.detach()
+
+
+table_readers = {"xlsx": xlsx_sheets, "xls": xls_sheets, "csv": csv_sheets}
+
+
+def write_rows(out: TextBudget, rows, max_rows: Optional[int]) -> int:
+    written = 0
+    for row in rows:
+        if max_rows is not None and written >= max_rows:
+            break
+        cells = row_cells(row)
+        if not cells:
+            continue
+        written += 1
+        if not out.add("\t".join(cell_text(c) for c in cells)):
+            break
+    return written
+
+
+def write_schema(out: TextBudget, total: Optional[int], rows) -> None:
+    header = None
+    sample = []
+    types: List[set] = []
+    scanned = 0
+    for row in rows:
+        cells = row_cells(row)
+        if not cells:
+            continue
+        if header is None:
+            header = cells
+            continue
+        scanned += 1
+        if len(types) < len(cells):
+            types.extend(set() for _ in range(len(cells) - len(types)))
+        for i, value in enumerate(cells):
+            kind = cell_type(value)
+            if kind is not None:
+                types[i].add(kind)
+        if len(sample) < TABLE_SAMPLE_ROWS:
+            sample.append(cells)
+        if scanned >= TABLE_SCHEMA_SCAN_ROWS:
+            break
+    if header is None:
+        out.add("(пусто)")
+        return
+    width = max(len(header), len(types))
+    names = [
+        cell_text(header[i]) if i < len(header) and header[i] is not None else ""
+        for i in range(width)
+    ]
+    columns = ", ".join(
+        f"{name or f'col{i + 1}'} ({column_type(types[i] if i < len(types) else set())})"
+        for i, name in enumerate(names)
+    )
+    out.add(f"rows: {total if total is not None else '?'}, columns: {width}")
+    out.add(f"columns: {columns}")
+    out.add("sample:")
+    for cells in sample:
+        if not out.add("\t".join(cell_text(c) for c in cells)):
+            return
+
+
+def table_bytes_to_text(
+    data,
+    max_chars: Optional[int] = None,
+    ext: str = "xlsx",
+    mode: str = "rows",
+    max_rows: Optional[int] = None,
+) -> str:
+    out = TextBudget(max_chars)
+    sheets = table_readers[ext](data)
+    with contextlib.closing(sheets):
+        for title, total, rows in sheets:
+            if title is not None and not out.add(f"=== Sheet: {title} ==="):
+                break
+            if mode == "schema":
+                write_schema(out, total, rows)
+            elif max_rows is not None:
+                max_rows -= write_rows(out, rows, max_rows)
+            else:
+                write_rows(out, rows, None)
+            if out.full or max_rows is not None and max_rows <= 0:
+                break
+    return out.text()
+
+
+def extract_text_from_bytes(
+    data,
+    name: str,
+    max_chars: Optional[int] = None,
+    table_mode: str = "rows",
+    max_rows: Optional[int] = None,
+) -> str:
+    if not name:
+        raise ValueError("Нужно указать имя файла (для определения расширения).")
+    ext = os.path.splitext(name)[-1].lower().lstrip(".")
+    if ext == "pdf":
+        return pdf_bytes_to_text(data, max_chars)
+    elif ext in table_readers:
+        return table_bytes_to_text(data, max_chars, ext, table_mode, max_rows)
+    elif ext in ("txt", "md"):
+        out = decode_prefix(as_bytes(data), max_chars)
+    elif ext == "json":
+        txt = try_decode(as_bytes(data))
+        try:
+            obj = json.loads(txt)
+            out = json.dumps(obj, ensure_ascii=False, indent=2)
+        except Exception:
+            out = txt
+    elif ext in ("html", "htm"):
+        out = html_to_text(as_bytes(data))
+    elif ext == "docx":
+        out = docx_bytes_to_text(data)
+    else:
+        raise ValueError(
+            f"Формат .{ext} не поддерживается лёгким экстрактором. Поддерживаем: pdf, xlsx, xls, csv, txt, md, json, html, docx"
+        )
+    return truncate(out, max_chars)
+
+
+def extract_text_from_path(
+    path: str,
+    max_chars: Optional[int] = None,
+    *,
+    name: Optional[str] = None,
+    table_mode: str = "rows",
+    max_rows: Optional[int] = None,
+) -> str:
+    with open(path, "rb") as f:
+        return extract_text_from_bytes(
+            f, name or os.path.basename(path), max_chars, table_mode, max_rows
+        )
+
+
+def warm_worker() -> int:
+    return os.getpid()
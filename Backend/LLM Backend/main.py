@@ -3,25 +3,12 @@ from pydantic import BaseModel
 import httpx
 import os
 from dotenv import load_dotenv
-from groq import Groq
-from fastapi.responses import JSONResponse
+from groq import AsyncGroq
+from fastapi.responses import JSONResponse, StreamingResponse
 import base64
-import zipfile
-from io import BytesIO
 import tempfile
-import xml.etree.ElementTree as ET
-from html.parser import HTMLParser
-import tempfile
-from io import BytesIO
-from openpyxl import load_workbook
-from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-import io
 import json
 import openai
-from cerebras.cloud.sdk import Cerebras
 from mem0 import AsyncMemoryClient
 import contextvars
 import re
@@ -30,11 +17,28 @@ from email.utils import parsedate_to_datetime
 import logging
 from typing import Any, Dict, List, Optional, Literal
 import asyncio
-
-try:
-    from docx import Document
-except Exception as e:
-    Document = None
+import time
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+import hashlib
+import functools
+import shutil
+import pwd
+import sys
+import math
+from tool_classifier import last_user_text, needs_tools
+from context_retrieval import relevant_messages
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import file_extraction
+from file_extraction import (
+    extract_text_from_bytes,
+    extract_text_from_path,
+    media_types,
+)
+import mmap
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 import logging.config
 import sentry_sdk
@@ -84,7 +88,20 @@ sentry_sdk.init(
 )
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await client_registry.start()
+    await python_sandbox.start()
+    await extraction_pool.start()
+    try:
+        yield
+    finally:
+        await extraction_pool.close()
+        await python_sandbox.close()
+        await client_registry.close()
+
+
+app = FastAPI(lifespan=lifespan)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY_1", "")
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY", "")
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY", "")
@@ -92,21 +109,14 @@ CLOUDFLARE_API_KEY = os.getenv("CLOUDFLARE_API_KEY", "")
 CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY_1", "")
 MEM0_API_KEY = os.getenv("MEM0_API_KEY", "")
 
-client = Cerebras(
-    api_key=os.environ.get("CEREBRAS_API_KEY_1"),
-)
-
 mem_client = AsyncMemoryClient(
     api_key=os.environ.get("MEM0_API_KEY"),
 )
 
 
-groqClient = Groq(
+groqClient = AsyncGroq(
     api_key=GROQ_API_KEY,
 )
-groqClient_1 = Groq(
-    api_key=os.environ.get("GROQ_API_KEY_2"),
-)
 providers = {
     "cerebras": {
         "base_url": "https://api.cerebras.ai/v1",
@@ -127,117 +137,364 @@ providers = {
     },
 }
 
+model_aliases = [
+    {
+        "cerebras": "llama-3.3-70b",
+        "groq": "llama-3.3-70b-versatile",
+        "openrouter": "meta-llama/llama-3.3-70b-instruct",
+    },
+    {
+        "cerebras": "llama3.1-8b",
+        "groq": "llama-3.1-8b-instant",
+        "openrouter": "meta-llama/llama-3.1-8b-instruct",
+    },
+    {
+        "cerebras": "qwen-3-32b",
+        "groq": "qwen/qwen3-32b",
+        "openrouter": "qwen/qwen3-32b",
+    },
+    {
+        "cerebras": "gpt-oss-120b",
+        "groq": "openai/gpt-oss-120b",
+        "openrouter": "openai/gpt-oss-120b",
+    },
+    {
+        "cerebras": "llama-4-scout-17b-16e-instruct",
+        "groq": "meta-llama/llama-4-scout-17b-16e-instruct",
+        "openrouter": "meta-llama/llama-4-scout",
+    },
+]
+
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "100"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "20"))
+HTTP_POOL_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes")
 
-class ChatMessage(BaseModel):
-    role: Literal["system", "user", "assistant", "function"]
-    content: str
 
+class ClientRegistry:
+    def __init__(
+        self,
+        max_connections: int = HTTP_POOL_MAX_CONNECTIONS,
+        max_keepalive: int = HTTP_POOL_MAX_KEEPALIVE,
+        keepalive_expiry: float = HTTP_POOL_KEEPALIVE_EXPIRY,
+        http2: bool = HTTP2_ENABLED,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self._http: Dict[str, httpx.AsyncClient] = {}
+        self._openai: Dict[tuple, openai.AsyncOpenAI] = {}
 
-class LLMRequest(BaseModel):
-    prompt: List[ChatMessage]
-    model: str
-    provider: list
-    is_agent: bool = False
+    def http(self, name: str) -> httpx.AsyncClient:
+        cl = self._http.get(name)
+        if cl is None or cl.is_closed:
+            try:
+                cl = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+            except ImportError:
+                logger.warning("h2 is not installed, falling back to HTTP/1.1")
+                self.http2 = False
+                cl = httpx.AsyncClient(limits=self.limits)
+            self._http[name] = cl
+        return cl
+
+    def openai_client(self, provider_name: str, api_key: str) -> openai.AsyncOpenAI:
+        key = (provider_name, api_key)
+        cl = self._openai.get(key)
+        if cl is None:
+            cl = openai.AsyncOpenAI(
+                base_url=providers[provider_name]["base_url"],
+                api_key=api_key,
+                http_client=self.http(provider_name),
+                max_retries=0,
+            )
+            self._openai[key] = cl
+        return cl
+
+    async def start(self):
+        for name, conf in providers.items():
+            for api_key in extract_api_keys_from_provider_conf(conf):
+                self.openai_client(name, api_key)
+        for name in ("mistral", "cloudflare", "wolfram"):
+            self.http(name)
+
+    async def close(self):
+        clients = list(self._http.values())
+        self._openai.clear()
+        self._http.clear()
+        for cl in clients:
+            try:
+                await cl.aclose()
+            except Exception:
+                logger.exception("Failed to close http client")
 
 
-class OcrRequest(BaseModel):
-    imageBase64: str
+client_registry = ClientRegistry()
 
 
-class FileRequest(BaseModel):
-    buffer: str
-    name: str
-    mime: str
+class Metrics:
+    def __init__(self):
+        self._counters: Dict[str, float] = {}
+        self._timings: Dict[str, Dict[str, float]] = {}
+
+    def inc(self, name: str, value: float = 1.0):
+        self._counters[name] = self._counters.get(name, 0.0) + value
+
+    def observe(self, name: str, value: float):
+        t = self._timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        t["count"] += 1
+        t["sum"] += value
+        t["max"] = max(t["max"], value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "counters": dict(self._counters),
+            "timings": {k: dict(v) for k, v in self._timings.items()},
+        }
 
 
-current_user_id = contextvars.ContextVar("current_user_id", default=None)
+metrics = Metrics()
 
 
-def try_decode(b: bytes) -> str:
-    for enc in ("utf-8", "cp1251", "latin1"):
-        try:
-            return b.decode(enc)
-        except Exception:
-            pass
-    return b.decode("utf-8", errors="ignore")
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[tuple, deque] = {}
 
+    def record(self, provider_name: str, model: str, seconds: float):
+        key = (provider_name, model)
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            self._samples[key] = samples
+        samples.append(seconds)
 
-def truncate_to_limit(s: str, limit: int = 3000) -> str:
-    if s is None:
-        return ""
-    return s[:limit]
+    def quantile(self, provider_name: str, model: str, q: float) -> Optional[float]:
+        samples = self._samples.get((provider_name, model))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = {}
+        for (provider_name, model), samples in self._samples.items():
+            ordered = sorted(samples)
+            n = len(ordered)
+            out[f"{provider_name}/{model}"] = {
+                "count": n,
+                "p50": ordered[int(0.5 * (n - 1))],
+                "p95": ordered[int(0.95 * (n - 1))],
+                "p99": ordered[int(0.99 * (n - 1))],
+            }
+        return out
 
 
-class _HTMLTextExtractor(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self._texts = []
-        self._skip = False
-        self._skip_tags = {"script", "style", "noscript"}
+latency_tracker = LatencyTracker()
 
-    def handle_starttag(self, tag, attrs):
-        t = tag.lower()
-        if t in self._skip_tags:
-            self._skip = True
-        if t in {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5"}:
-            self._texts.append("\n")
+HEDGE_ENABLED = os.getenv("HEDGE_REQUESTS", "false").lower() in ("1", "true", "yes")
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.9"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3.0"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
 
-    def handle_endtag(self, tag):
-        t = tag.lower()
-        if t in self._skip_tags:
-            self._skip = False
-        if t in {"p", "div", "li", "tr"}:
-            self._texts.append("\n")
 
-    def handle_data(self, data):
-        if not self._skip:
-            self._texts.append(data)
+class HedgePolicy:
+    def __init__(
+        self,
+        quantile: float = HEDGE_QUANTILE,
+        default_delay: float = HEDGE_DEFAULT_DELAY,
+        min_delay: float = HEDGE_MIN_DELAY,
+        max_rate: float = HEDGE_MAX_RATE,
+        window: int = 500,
+    ):
+        self.quantile = quantile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self._decisions: deque = deque(maxlen=window)
+
+    def delay_for(self, provider_name: str, model: str) -> float:
+        learned = latency_tracker.quantile(provider_name, model, self.quantile)
+        if learned is None:
+            return self.default_delay
+        return max(self.min_delay, learned)
+
+    def record_request(self) -> List[bool]:
+        decision = [False]
+        self._decisions.append(decision)
+        return decision
+
+    def allow_hedge(self, decision: List[bool]) -> bool:
+        if decision[0]:
+            return True
+        hedged = sum(d[0] for d in self._decisions)
+        if hedged + 1 > self.max_rate * max(len(self._decisions), 1):
+            return False
+        decision[0] = True
+        return True
+
+
+hedge_policy = HedgePolicy()
+
+
+lru_caches: List["LRUCache"] = []
+
+
+class LRUCache:
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        max_bytes: int,
+        ttl: Optional[float] = None,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        lru_caches.append(self)
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            metrics.inc(f"{self.name}_miss")
+            return None
+        value, size, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._drop(key)
+            metrics.inc(f"{self.name}_miss")
+            return None
+        self._data.move_to_end(key)
+        metrics.inc(f"{self.name}_hit")
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        item = self._data.get(key)
+        return item is not None and (item[2] is None or item[2] > time.monotonic())
+
+    def set(self, key: str, value: Any, size: int, ttl: Optional[float] = None):
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._drop(key)
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (value, size, expires_at)
+        self.bytes += size
+        while self._data and (
+            len(self._data) > self.max_entries or self.bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._data))
+            self._drop(oldest)
+            metrics.inc(f"{self.name}_evicted")
+
+    def _drop(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        counters = metrics.snapshot()["counters"]
+        hits = counters.get(f"{self.name}_hit", 0)
+        misses = counters.get(f"{self.name}_miss", 0)
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
 
-    def get_text(self):
-        txt = "".join(self._texts)
-        lines = [line.strip() for line in txt.splitlines()]
-        return "\n".join([l for l in lines if l])
 
+def cache_key_for(*parts: Any) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-def html_to_text(html_bytes: bytes) -> str:
-    parser = _HTMLTextExtractor()
-    parser.feed(try_decode(html_bytes))
-    return parser.get_text()
 
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, Dict[str, Any]] = {}
 
-def docx_bytes_to_text(b: bytes) -> str:
+    async def do(self, key: str, fn):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(fn())
+            call = {"task": task, "waiters": 0}
+            self._calls[key] = call
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            metrics.inc(f"{self.name}_shared")
 
-    if Document is None:
-        raise RuntimeError("python-docx не установлен (pip install python-docx)")
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"])
+        except asyncio.CancelledError:
+            if call["waiters"] == 1 and not call["task"].done():
+                call["task"].cancel()
+            raise
+        finally:
+            call["waiters"] -= 1
 
-    bio = BytesIO(b)
-    doc = Document(bio)
+    def _finish(self, key: str, task: asyncio.Future):
+        if self._calls.get(key, {}).get("task") is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
 
-    parts = []
-    for p in doc.paragraphs:
-        if p.text:
-            parts.append(p.text)
+    def in_flight(self) -> int:
+        return len(self._calls)
 
-    for table in doc.tables:
-        for row in table.rows:
-            row_texts = [cell.text for cell in row.cells]
-            if any(row_texts):
-                parts.append("\t".join(row_texts))
 
-    try:
-        for section in doc.sections:
-            header = section.header
-            footer = section.footer
-            for p in header.paragraphs:
-                if p.text:
-                    parts.append(p.text)
-            for p in footer.paragraphs:
-                if p.text:
-                    parts.append(p.text)
-    except Exception:
-        pass
+completion_cache = LRUCache(
+    "completion_cache",
+    max_entries=int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "2000")),
+    max_bytes=int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.getenv("COMPLETION_CACHE_TTL", "600")),
+)
+completion_flights = SingleFlight("completion_singleflight")
 
-    return "\n".join(parts)
+
+class ChatMessage(BaseModel):
+    role: Literal["system", "user", "assistant", "function"]
+    content: str
+
+
+class LLMRequest(BaseModel):
+    prompt: List[ChatMessage]
+    model: str
+    provider: list
+    is_agent: bool = False
+    stream: bool = False
+    hedge: Optional[bool] = None
+    cache: bool = True
+    agent_mode: Optional[Literal["auto", "separate", "direct", "reuse"]] = None
+    context_mode: Optional[Literal["recent", "summary", "retrieval"]] = None
+    chat_id: Optional[str] = None
+    history: Literal["full", "delta"] = "full"
+
+
+class OcrRequest(BaseModel):
+    imageBase64: str
+
+
+class FileRequest(BaseModel):
+    buffer: str
+    name: str
+    mime: str
+    table_mode: Optional[Literal["rows", "schema"]] = None
+
+
+current_user_id = contextvars.ContextVar("current_user_id", default=None)
 
 
 @app.middleware("http")
@@ -257,6 +514,8 @@ async def llm_query(request: LLMRequest):
         return await query_mistral(request)
     elif "cloudflare" in prodiver:
         return await query_cloudflare(request)
+    elif request.stream:
+        return await providerRoutingStream(request)
     else:
         return await providerRouting(request)
 
@@ -264,7 +523,25 @@ async def llm_query(request: LLMRequest):
 @app.post("/ocr")
 async def ocr_query(req: OcrRequest):
     imageBase64 = req.imageBase64
-    chat_completion = groqClient.chat.completions.create(
+    return await recognize_image(base64.b64decode(imageBase64), imageBase64)
+
+
+@app.post("/ocr/upload")
+async def ocr_upload(request: Request):
+    async with read_upload(request) as upload:
+        return await recognize_image(upload.data, digest=upload.digest)
+
+
+async def recognize_image(
+    data, imageBase64: Optional[str] = None, digest: Optional[str] = None
+):
+    cache_key = await extraction_cache.key("ocr", data, digest)
+    cached = await extraction_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if imageBase64 is None:
+        imageBase64 = base64.b64encode(data).decode("ascii")
+    chat_completion = await groqClient.chat.completions.create(
         messages=[
             {
                 "role": "user",
@@ -281,203 +558,525 @@ async def ocr_query(req: OcrRequest):
         ],
         model="meta-llama/llama-4-scout-17b-16e-instruct",
     )
-    return chat_completion.choices[0].message.content
+    content = chat_completion.choices[0].message.content
+    await extraction_cache.set(cache_key, content)
+    return content
 
 
 @app.post("/files")
 async def files_recognize(req: FileRequest):
-    data = base64.b64decode(req.buffer)
+    return await recognize_file(
+        req.name, base64.b64decode(req.buffer), table_mode=req.table_mode
+    )
+
+
+@app.post("/files/upload")
+async def files_upload(
+    request: Request,
+    name: str = "",
+    mime: str = "",
+    table_mode: Optional[Literal["rows", "schema"]] = None,
+):
+    async with read_upload(request) as upload:
+        return await recognize_file(
+            name or upload.filename,
+            upload.data,
+            upload.path,
+            upload.digest,
+            table_mode,
+        )
+
+
+async def recognize_file(
+    name: str,
+    data,
+    path: Optional[str] = None,
+    digest: Optional[str] = None,
+    table_mode: Optional[str] = None,
+):
     mediaType = ""
-    ext = req.name.rsplit(".", 1)[-1].lower()
-
-    if ext == "pdf":
-        rsrcmgr = PDFResourceManager()
-        laparams = LAParams()
-        retstr = io.StringIO()
-        device = TextConverter(rsrcmgr, retstr, laparams=laparams)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
-
-        fp = BytesIO(data)
-        fp.seek(0)
-
-        total_text = ""
-        mediaType = "pdf"
-        for page in PDFPage.get_pages(fp, check_extractable=False):
-            interpreter.process_page(page)
-            page_text = retstr.getvalue()
-            retstr.truncate(0)
-            retstr.seek(0)
-
-            remaining = 3000 - len(total_text)
-            total_text += page_text[:remaining]
-            if len(total_text) >= 3000:
-                break
+    ext = name.rsplit(".", 1)[-1].lower() if name and "." in name else ""
+    is_audio = ext in ("mp3", "wav", "ogg", "m4a")
+    if media_types.get(ext) == "table":
+        max_chars = EXTRACT_TABLE_LIMIT
+        table_mode = table_mode or EXTRACT_TABLE_MODE
+        max_rows = EXTRACT_TABLE_MAX_ROWS
+    else:
+        max_chars = EXTRACT_TEXT_LIMIT
+        table_mode = max_rows = None
+    cache_key = await extraction_cache.key(
+        "audio" if is_audio else "files",
+        data,
+        digest,
+        ext=ext,
+        max_chars=max_chars,
+        table_mode=table_mode,
+        max_rows=max_rows,
+    )
+    cached = await extraction_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
-        device.close()
-        retstr.close()
-        fp.close()
-        return total_text
-    elif ext in ("xls", "xlsx"):
-        wb = load_workbook(filename=BytesIO(data), read_only=True)
-        parts = []
-        for ws in wb.worksheets:
-            parts.append(f"=== Sheet: {ws.title} ===")
-            for row in ws.iter_rows(values_only=True):
-                line = "\t".join("" if c is None else str(c) for c in row)
-                parts.append(line)
-        text = "\n".join(parts)
-        mediaType = "table"
-    elif ext in ("mp3", "wav", "ogg", "m4a"):
-        tmp_path = None
+    if is_audio:
         try:
-            with tempfile.NamedTemporaryFile(suffix=f".{ext}", delete=False) as tmp:
-                tmp.write(data)
-                tmp_path = tmp.name
-
-            with open(tmp_path, "rb") as f:
-                result = groqClient.audio.transcriptions.create(
-                    model="whisper-large-v3",
-                    file=("audio." + ext, f.read(), f"audio/{ext}"),
-                    response_format="text",
-                    prompt="Дословно напиши, точную расшифровку текста на том языке на котором аудио записано, и ничего не более, если ты не нашёл слов в аудио файле, то опиши  что за звуки там.",
+            if path is not None:
+                with open(path, "rb") as f:
+                    result = await transcribe_audio(ext, f)
+            else:
+                result = await transcribe_audio(
+                    ext, data if isinstance(data, bytes) else bytes(data)
                 )
             mediaType = "audio"
             text = json.dumps(result, indent=2, ensure_ascii=False)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-
-    else:
-        ext = (
-            req.name.rsplit(".", 1)[-1].lower() if req.name and "." in req.name else ""
-        )
-        suffix = f".{ext}" if ext else ""
-        tmp_path = None
-        try:
-            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
-                tmp.write(data)
-                tmp_path = tmp.name
-
-            if ext in ("txt", "md"):
-                text = try_decode(data)
-                mediaType = "text"
+        result = {"content": text, "type": mediaType}
+        await extraction_cache.set(cache_key, result)
+        return result
 
-            elif ext == "json":
-                raw = try_decode(data)
-                try:
-                    parsed = json.loads(raw)
-                    text = json.dumps(parsed, ensure_ascii=False, indent=2)
-                except Exception:
-                    text = raw
-                mediaType = "json"
-            elif ext in ("html", "htm"):
-                text = html_to_text(data)
-                mediaType = "html"
-            elif ext == "docx":
-
-                text = docx_bytes_to_text(data)
-                mediaType = "document"
-            else:
-                raise RuntimeError(
-                    f"Формат .{ext} не поддерживается лёгким экстрактором. Поддерживаем: txt, md, json, html, docx"
+    mediaType = media_types.get(ext, "text")
+    try:
+        if path is not None:
+            text = await extraction_pool.run(
+                functools.partial(
+                    extract_text_from_path,
+                    path,
+                    max_chars,
+                    name=name,
+                    table_mode=table_mode,
+                    max_rows=max_rows,
                 )
-            text = truncate_to_limit(text, 3000)
-
-        except Exception as e:
-            return {"error": "Processing failed", "detail": str(e)}
-
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                try:
-                    os.unlink(tmp_path)
-                except OSError:
-                    pass
-
-    return {"content": text, "type": mediaType}
-
+            )
+        else:
+            text = await extraction_pool.run(
+                extract_text_from_bytes, data, name, max_chars, table_mode, max_rows
+            )
+    except ExtractionPoolError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        return {"error": "Processing failed", "detail": str(e)}
 
-def try_decode(b: bytes) -> str:
-    for enc in ("utf-8", "cp1251", "latin1"):
-        try:
-            return b.decode(enc)
-        except Exception:
-            pass
-    return b.decode("utf-8", errors="ignore")
+    result = {"content": text, "type": mediaType}
+    await extraction_cache.set(cache_key, result)
+    return result
 
 
-def truncate(s: str, limit: Optional[int]) -> str:
-    if limit is None:
-        return s
-    return s[:limit]
+async def transcribe_audio(ext: str, content):
+    return await groqClient.audio.transcriptions.create(
+        model="whisper-large-v3",
+        file=("audio." + ext, content, f"audio/{ext}"),
+        response_format="text",
+        prompt="Дословно напиши, точную расшифровку текста на том языке на котором аудио записано, и ничего не более, если ты не нашёл слов в аудио файле, то опиши  что за звуки там.",
+    )
 
 
-class _HTMLTextExtractor(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self._texts = []
-        self._skip = False
-        self._skip_tags = {"script", "style", "noscript"}
+UPLOAD_SPOOL_MAX_MEMORY = int(
+    os.getenv("UPLOAD_SPOOL_MAX_MEMORY", str(4 * 1024 * 1024))
+)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+
+class UploadBuffer:
+    def __init__(self, max_memory: int = UPLOAD_SPOOL_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.filename = ""
+        self.size = 0
+        self.path: Optional[str] = None
+        self._memory = bytearray()
+        self._file = None
+        self._mmap = None
+        self._view = None
+        self._sha256 = hashlib.sha256()
+
+    @property
+    def digest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+        if self.size > UPLOAD_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Файл слишком большой")
+        if self._file is None and self.size <= self.max_memory:
+            self._memory += chunk
+            return
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(prefix="upload-", delete=False)
+            self.path = self._file.name
+            self._file.write(self._memory)
+            self._memory = bytearray()
+            metrics.inc("upload_spooled_to_disk")
+        self._file.write(chunk)
+
+    @property
+    def data(self):
+        if self._file is None:
+            return self._memory
+        if self._view is None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        return self._view
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
 
-    def handle_starttag(self, tag, attrs):
-        if tag.lower() in self._skip_tags:
-            self._skip = True
-        if tag.lower() in {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5"}:
-            self._texts.append("\n")
 
-    def handle_endtag(self, tag):
-        if tag.lower() in self._skip_tags:
-            self._skip = False
-        if tag.lower() in {"p", "div", "li", "tr"}:
-            self._texts.append("\n")
+def check_content_length(request: Request, limit: int):
+    try:
+        length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный Content-Length")
+    if length > limit:
+        metrics.inc("upload_rejected_content_length")
+        raise HTTPException(status_code=413, detail="Файл слишком большой")
+
+
+async def read_multipart(request: Request, upload: UploadBuffer, boundary: bytes):
+    part: Dict[str, Any] = {}
+    name = bytearray()
+    files = 0
+
+    def on_part_begin():
+        part.clear()
+        part["headers"] = {}
+        part["field"] = bytearray()
+        part["value"] = bytearray()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        part["field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][bytes(part["field"]).lower()] = bytes(part["value"])
+        part["field"] = bytearray()
+        part["value"] = bytearray()
+
+    def on_headers_finished():
+        nonlocal files
+        _, options = parse_options_header(
+            part["headers"].get(b"content-disposition", b"")
+        )
+        part["name"] = options.get(b"name", b"")
+        if part["name"] == b"file":
+            files += 1
+            if files > 1:
+                raise HTTPException(status_code=400, detail="Нужен один файл")
+            upload.filename = options.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if part["name"] == b"file":
+            upload.write(data[start:end])
+        elif part["name"] == b"name":
+            name.extend(data[start:end])
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+        },
+    )
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD:
+            raise HTTPException(status_code=413, detail="Файл слишком большой")
+        parser.write(chunk)
+    parser.finalize()
+    if not files:
+        raise HTTPException(status_code=400, detail="Нужно поле file")
+    if name:
+        upload.filename = name.decode("utf-8", "replace")
+
+
+@asynccontextmanager
+async def read_upload(request: Request):
+    upload = UploadBuffer()
+    try:
+        content_type, options = parse_options_header(
+            request.headers.get("content-type", "")
+        )
+        if content_type == b"multipart/form-data":
+            check_content_length(request, UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD)
+            boundary = options.get(b"boundary")
+            if not boundary:
+                raise HTTPException(status_code=400, detail="Нет boundary в multipart")
+            await read_multipart(request, upload, boundary)
+        else:
+            check_content_length(request, UPLOAD_MAX_BYTES)
+            async for chunk in request.stream():
+                upload.write(chunk)
+        metrics.observe("upload_bytes", upload.size)
+        yield upload
+    finally:
+        upload.close()
+
+
+EXTRACT_TEXT_LIMIT = 3000
+EXTRACT_TABLE_LIMIT = int(os.getenv("EXTRACT_TABLE_LIMIT", "20000"))
+EXTRACT_TABLE_MAX_ROWS = int(os.getenv("EXTRACT_TABLE_MAX_ROWS", "1000"))
+EXTRACT_TABLE_MODE = os.getenv("EXTRACT_TABLE_MODE", "rows")
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXTRACT_MAX_QUEUE = int(os.getenv("EXTRACT_MAX_QUEUE", "32"))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "60"))
+
+
+class ExtractionPoolError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+class ExtractionPool:
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(workers)
+        self._lock = asyncio.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["file_extraction"])
+        else:
+            ctx = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+
+    async def _ready_executor(self) -> ProcessPoolExecutor:
+        async with self._lock:
+            if self._executor is None:
+                executor = self._new_executor()
+                loop = asyncio.get_running_loop()
+                await asyncio.gather(
+                    *[
+                        loop.run_in_executor(executor, file_extraction.warm_worker)
+                        for _ in range(self.workers)
+                    ]
+                )
+                self._executor = executor
+            return self._executor
 
-    def handle_data(self, data):
-        if not self._skip:
-            self._texts.append(data)
+    def _restart(self, executor: ProcessPoolExecutor):
+        if self._executor is executor:
+            self._executor = None
+        for proc in list((getattr(executor, "_processes", None) or {}).values()):
+            try:
+                proc.kill()
+            except Exception:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+        metrics.inc("extract_pool_restarts")
+
+    async def start(self):
+        await self._ready_executor()
+
+    async def close(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.workers),
+        }
 
-    def get_text(self):
-        txt = "".join(self._texts)
-        lines = [line.strip() for line in txt.splitlines()]
-        return "\n".join([l for l in lines if l])
+    async def run(self, fn, *args):
+        if self.in_flight >= self.workers + self.max_queue:
+            metrics.inc("extract_rejected")
+            raise ExtractionPoolError(503, "Очередь обработки файлов переполнена")
+        self.in_flight += 1
+        metrics.observe("extract_queue_depth", max(0, self.in_flight - self.workers))
+        queued_at = time.perf_counter()
+        try:
+            async with self._slots:
+                metrics.observe("extract_wait_seconds", time.perf_counter() - queued_at)
+                started = time.perf_counter()
+                try:
+                    return await self._run_once(fn, *args)
+                finally:
+                    metrics.observe("extract_seconds", time.perf_counter() - started)
+        finally:
+            self.in_flight -= 1
 
+    async def _run_once(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = await self._ready_executor()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(executor, fn, *args), timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                metrics.inc("extract_timeout")
+                self._restart(executor)
+                raise ExtractionPoolError(
+                    504, f"Обработка файла превысила {self.timeout:g}s"
+                )
+            except BrokenProcessPool:
+                metrics.inc("extract_pool_broken")
+                self._restart(executor)
+                if attempt:
+                    raise ExtractionPoolError(
+                        500, "Процесс обработки файла аварийно завершился"
+                    )
 
-def html_to_text(html_bytes: bytes) -> str:
-    parser = _HTMLTextExtractor()
-    parser.feed(try_decode(html_bytes))
-    return parser.get_text()
 
+extraction_pool = ExtractionPool(EXTRACT_WORKERS, EXTRACT_MAX_QUEUE, EXTRACT_TIMEOUT)
 
-def extract_text_from_bytes(
-    data: bytes, name: str, max_chars: Optional[int] = None
-) -> str:
-    if not name:
-        raise ValueError("Нужно указать имя файла (для определения расширения).")
-    ext = os.path.splitext(name)[-1].lower().lstrip(".")
-    if ext in ("txt", "md"):
-        out = try_decode(data)
-    elif ext == "json":
-        txt = try_decode(data)
+EXTRACTOR_VERSIONS = {
+    "files": f"{file_extraction.PDF_ENGINE}:3",
+    "audio": "whisper-large-v3:1",
+    "ocr": "llama-4-scout-17b-16e-instruct:1",
+}
+EXTRACT_CACHE_DIR = os.getenv(
+    "EXTRACT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "llm-extract-cache")
+)
+EXTRACT_CACHE_MAX_DISK_BYTES = int(
+    os.getenv("EXTRACT_CACHE_MAX_DISK_BYTES", str(512 * 1024 * 1024))
+)
+EXTRACT_CACHE_TTL = float(os.getenv("EXTRACT_CACHE_TTL", str(30 * 24 * 3600)))
+EXTRACT_CACHE_EVICT_EVERY = 50
+
+
+class ExtractionCache:
+    def __init__(self, directory: str, max_disk_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory = LRUCache(
+            "extract_cache",
+            max_entries=int(os.getenv("EXTRACT_CACHE_MAX_ENTRIES", "2000")),
+            max_bytes=int(os.getenv("EXTRACT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl=ttl,
+        )
+        self._writes = 0
+        self._written = 0
         try:
-            obj = json.loads(txt)
-            out = json.dumps(obj, ensure_ascii=False, indent=2)
-        except Exception:
-            out = txt
-    elif ext in ("html", "htm"):
-        out = html_to_text(data)
-    elif ext == "docx":
-        out = docx_bytes_to_text(data)
-    else:
-        raise ValueError(f"Формат .{ext} не поддерживается этим лёгким экстрактором.")
-    return truncate(out, max_chars)
+            os.makedirs(directory, exist_ok=True)
+            self.enabled = max_disk_bytes > 0
+        except OSError as e:
+            logger.warning("Extraction disk cache disabled: %s", e)
+            self.enabled = False
+
+    async def key(
+        self, kind: str, data, digest: Optional[str] = None, **params: Any
+    ) -> str:
+        if digest is None and len(data) > 1024 * 1024:
+            digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        elif digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        return cache_key_for(kind, EXTRACTOR_VERSIONS[kind], digest, params)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if st.st_mtime + self.ttl <= time.time():
+                os.unlink(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
 
+    def _write(self, key: str, raw: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        now = time.time()
+        target = int(self.max_disk_bytes * 0.9)
+        for mtime, size, path in sorted(entries):
+            if total <= target and mtime + self.ttl > now:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+                metrics.inc("extract_cache_disk_evicted")
+            except OSError:
+                pass
 
-def extract_text_from_path(path: str, max_chars: Optional[int] = None) -> str:
-    with open(path, "rb") as f:
-        data = f.read()
-    name = os.path.basename(path)
-    return extract_text_from_bytes(data, name=name, max_chars=max_chars)
+    async def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None or not self.enabled:
+            return value
+        value = await asyncio.to_thread(self._read, key)
+        if value is None:
+            metrics.inc("extract_cache_disk_miss")
+            return None
+        metrics.inc("extract_cache_disk_hit")
+        raw = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self.memory.set(key, value, len(raw))
+        return value
+
+    async def set(self, key: str, value: Any):
+        if value is None:
+            return
+        raw = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self.memory.set(key, value, len(raw))
+        if not self.enabled:
+            return
+        try:
+            await asyncio.to_thread(self._write, key, raw)
+        except OSError as e:
+            logger.warning("Extraction cache write failed: %s", e)
+            return
+        self._writes += 1
+        self._written += len(raw)
+        if (
+            self._writes % EXTRACT_CACHE_EVICT_EVERY == 0
+            or self._written > self.max_disk_bytes // 10
+        ):
+            self._written = 0
+            await asyncio.to_thread(self._evict)
+
+
+extraction_cache = ExtractionCache(
+    EXTRACT_CACHE_DIR, EXTRACT_CACHE_MAX_DISK_BYTES, EXTRACT_CACHE_TTL
+)
 
 
 @app.get("/", include_in_schema=False)
@@ -490,25 +1089,45 @@ async def healthz():
     return JSONResponse({"status": "healthy"})
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return JSONResponse(
+        {
+            **metrics.snapshot(),
+            "latency": latency_tracker.snapshot(),
+            "caches": {c.name: c.stats() for c in lru_caches},
+            "token_calibration": token_counter.snapshot(),
+            "extraction": extraction_pool.snapshot(),
+        }
+    )
+
+
 async def query_mistral(request: LLMRequest):
     url = "https://api.mistral.ai/v1/chat/completions"
     headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}"}
+    try:
+        session = open_session(request)
+    except ProviderRoutingError as e:
+        return e.to_response()
     payload = {
         "model": request.model,
-        "messages": [m.dict() for m in request.prompt],
+        "messages": (
+            session["messages"] if session else [m.dict() for m in request.prompt]
+        ),
     }
     timeout = httpx.Timeout(connect=10.0, read=120.0, write=60.0, pool=10.0)
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json=payload, headers=headers, timeout=timeout)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        data = resp.json()
-        return JSONResponse(
-            content={
-                "type": "text",
-                "content": data["choices"][0]["message"]["content"],
-            }
-        )
+    client = client_registry.http("mistral")
+    resp = await client.post(url, json=payload, headers=headers, timeout=timeout)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    data = resp.json()
+    commit_session(session, data["choices"][0]["message"]["content"])
+    return JSONResponse(
+        content={
+            "type": "text",
+            "content": data["choices"][0]["message"]["content"],
+        }
+    )
 
 
 async def query_cloudflare(request: LLMRequest):
@@ -521,59 +1140,57 @@ async def query_cloudflare(request: LLMRequest):
         write=60.0,
         pool=5.0,
     )
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        try:
-            resp = await client.post(url, json=payload, headers=headers)
-        except httpx.ReadTimeout:
-            raise HTTPException(504, "Upstream Read Timeout: модель не успела ответить")
-        except httpx.RequestError as e:
-            raise HTTPException(502, f"Upstream Request Error: {e}")
+    client = client_registry.http("cloudflare")
+    try:
+        resp = await client.post(url, json=payload, headers=headers, timeout=timeout)
+    except httpx.ReadTimeout:
+        raise HTTPException(504, "Upstream Read Timeout: модель не успела ответить")
+    except httpx.RequestError as e:
+        raise HTTPException(502, f"Upstream Request Error: {e}")
 
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
 
-        ct = resp.headers.get("content-type", "")
-        if "application/json" in ct or resp.text.strip().startswith(("{", "[")):
-            try:
-                data = resp.json()
-                candidate = None
-                if isinstance(data, dict):
-                    result = data.get("result", data)
-                    for key in ("image", "images", "artifact", "artifacts"):
-                        candidate = (
-                            result.get(key) if isinstance(result, dict) else None
+    ct = resp.headers.get("content-type", "")
+    if "application/json" in ct or resp.text.strip().startswith(("{", "[")):
+        try:
+            data = resp.json()
+            candidate = None
+            if isinstance(data, dict):
+                result = data.get("result", data)
+                for key in ("image", "images", "artifact", "artifacts"):
+                    candidate = result.get(key) if isinstance(result, dict) else None
+                    if candidate:
+                        break
+            if isinstance(candidate, list) and candidate:
+                candidate = candidate[0]
+            if isinstance(candidate, dict):
+                for k in ("b64", "base64", "data", "image"):
+                    if k in candidate:
+                        candidate = candidate[k]
+                        break
+            if isinstance(candidate, str):
+                b64 = (
+                    candidate.split("base64,", 1)[-1]
+                    if candidate.startswith("data:") and "base64," in candidate
+                    else candidate
+                )
+                try:
+                    base64.b64decode(b64, validate=True)
+                    return JSONResponse(content={"type": "image", "content": b64})
+                except Exception:
+                    if b64.startswith("http://") or b64.startswith("https://"):
+                        return JSONResponse(
+                            content={"type": "image_url", "content": b64}
                         )
-                        if candidate:
-                            break
-                if isinstance(candidate, list) and candidate:
-                    candidate = candidate[0]
-                if isinstance(candidate, dict):
-                    for k in ("b64", "base64", "data", "image"):
-                        if k in candidate:
-                            candidate = candidate[k]
-                            break
-                if isinstance(candidate, str):
-                    b64 = (
-                        candidate.split("base64,", 1)[-1]
-                        if candidate.startswith("data:") and "base64," in candidate
-                        else candidate
-                    )
-                    try:
-                        base64.b64decode(b64, validate=True)
-                        return JSONResponse(content={"type": "image", "content": b64})
-                    except Exception:
-                        if b64.startswith("http://") or b64.startswith("https://"):
-                            return JSONResponse(
-                                content={"type": "image_url", "content": b64}
-                            )
-                        return JSONResponse(content={"type": "json", "content": data})
-            except Exception:
-                pass
+                    return JSONResponse(content={"type": "json", "content": data})
+        except Exception:
+            pass
 
-        raw = await resp.aread()
-        return JSONResponse(
-            content={"type": "image", "content": base64.b64encode(raw).decode("ascii")}
-        )
+    raw = await resp.aread()
+    return JSONResponse(
+        content={"type": "image", "content": base64.b64encode(raw).decode("ascii")}
+    )
 
 
 def add_prefix_if_first_is_system(full_messages: list, prefix: str) -> list:
@@ -667,37 +1284,40 @@ def extract_headers_from_exception(e: Exception) -> Dict[str, str]:
     return hdrs
 
 
-def parse_retry_seconds_from_headers(hdrs: Dict[str, str]) -> Optional[float]:
-    if not hdrs:
+def parse_time_value(v: str) -> Optional[float]:
+    if not v:
         return None
+    s = v.strip().lower()
+    if re.match(r"^\d+(\.\d+)?$", s):
+        return float(s)
+    total = 0.0
+    found = False
+    for val, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|[smh])", s):
+        found = True
+        fv = float(val)
+        if unit == "ms":
+            total += fv / 1000
+        elif unit == "s":
+            total += fv
+        elif unit == "m":
+            total += fv * 60
+        elif unit == "h":
+            total += fv * 3600
+    if found:
+        return total
+    try:
+        dt = parsedate_to_datetime(v)
+        if dt is not None:
+            now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+            delta = (dt - now).total_seconds()
+            return max(delta, 0.0)
+    except Exception:
+        pass
+    return None
 
-    def parse_time_value(v: str) -> Optional[float]:
-        if not v:
-            return None
-        s = v.strip().lower()
-        if re.match(r"^\d+(\.\d+)?$", s):
-            return float(s)
-        total = 0.0
-        found = False
-        for val, unit in re.findall(r"(\d+(?:\.\d+)?)([smh])", s):
-            found = True
-            fv = float(val)
-            if unit == "s":
-                total += fv
-            elif unit == "m":
-                total += fv * 60
-            elif unit == "h":
-                total += fv * 3600
-        if found:
-            return total
-        try:
-            dt = parsedate_to_datetime(v)
-            if dt is not None:
-                now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-                delta = (dt - now).total_seconds()
-                return max(delta, 0.0)
-        except Exception:
-            pass
+
+def parse_retry_seconds_from_headers(hdrs: Dict[str, str]) -> Optional[float]:
+    if not hdrs:
         return None
 
     ra = hdrs.get("retry-after")
@@ -722,13 +1342,144 @@ def parse_retry_seconds_from_headers(hdrs: Dict[str, str]) -> Optional[float]:
     return None
 
 
+def parse_rate_limit_state(hdrs: Dict[str, str]) -> Dict[str, Any]:
+    remaining: Dict[str, float] = {}
+    exhausted_reset: Optional[float] = None
+    for k, v in (hdrs or {}).items():
+        if not k.startswith("x-ratelimit-remaining-"):
+            continue
+        suffix = k[len("x-ratelimit-remaining-") :]
+        try:
+            remaining[suffix] = float(v)
+        except (TypeError, ValueError):
+            continue
+        if remaining[suffix] <= 0:
+            reset = parse_time_value(hdrs.get(f"x-ratelimit-reset-{suffix}", ""))
+            if reset is not None:
+                exhausted_reset = max(exhausted_reset or 0.0, reset)
+    return {"remaining": remaining, "exhausted_reset": exhausted_reset}
+
+
+KEY_COOLDOWN_ON_429 = 1.0
+KEY_COOLDOWN_ON_402 = 60.0
+KEY_MAX_COOLDOWN = 300.0
+
+
+class KeyState:
+    def __init__(self, provider_name: str, api_key: str):
+        self.provider_name = provider_name
+        self.api_key = api_key
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.remaining: Dict[str, float] = {}
+        self.last_used = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    def cooling(self, now: Optional[float] = None) -> bool:
+        return self.cooldown_until > (now if now is not None else time.monotonic())
+
+    def min_remaining(self) -> float:
+        return min(self.remaining.values()) if self.remaining else float("inf")
+
+
+class KeyScheduler:
+    def __init__(self):
+        self._states: Dict[tuple, KeyState] = {}
+
+    def state(self, provider_name: str, api_key: str) -> KeyState:
+        key = (provider_name, api_key)
+        st = self._states.get(key)
+        if st is None:
+            st = KeyState(provider_name, api_key)
+            self._states[key] = st
+        return st
+
+    def acquire(
+        self, provider_name: str, api_keys: List[str], exclude=()
+    ) -> Optional[KeyState]:
+        now = time.monotonic()
+        candidates = [
+            self.state(provider_name, k)
+            for k in api_keys
+            if k not in exclude and not self.state(provider_name, k).cooling(now)
+        ]
+        if not candidates:
+            return None
+        st = min(
+            candidates, key=lambda c: (c.in_flight, -c.min_remaining(), c.last_used)
+        )
+        st.in_flight += 1
+        st.last_used = now
+        return st
+
+    def release(self, st: KeyState):
+        st.in_flight = max(0, st.in_flight - 1)
+
+    def next_available_in(
+        self, provider_name: str, api_keys: List[str], exclude=()
+    ) -> Optional[float]:
+        now = time.monotonic()
+        waits = [
+            self.state(provider_name, k).cooldown_until - now
+            for k in api_keys
+            if k not in exclude
+        ]
+        if not waits:
+            return None
+        return max(0.0, min(waits))
+
+    def cooldown(self, st: KeyState, seconds: float):
+        seconds = min(max(seconds, 0.0), KEY_MAX_COOLDOWN)
+        st.cooldown_until = max(st.cooldown_until, time.monotonic() + seconds)
+
+    def record_success(self, st: KeyState, hdrs: Dict[str, str]):
+        st.successes += 1
+        self._apply_headers(st, hdrs)
+
+    def record_failure(self, st: KeyState, status: Optional[int], hdrs: Dict[str, str]):
+        st.failures += 1
+        self._apply_headers(st, hdrs)
+        retry = parse_retry_seconds_from_headers(hdrs)
+        if retry is not None:
+            self.cooldown(st, retry)
+        elif status == 429:
+            self.cooldown(st, KEY_COOLDOWN_ON_429)
+        elif status == 402:
+            self.cooldown(st, KEY_COOLDOWN_ON_402)
+
+    def _apply_headers(self, st: KeyState, hdrs: Dict[str, str]):
+        if not hdrs:
+            return
+        parsed = parse_rate_limit_state(hdrs)
+        if parsed["remaining"]:
+            st.remaining = parsed["remaining"]
+        if parsed["exhausted_reset"] is not None:
+            self.cooldown(st, parsed["exhausted_reset"])
+        ra = parse_time_value(hdrs.get("retry-after", ""))
+        if ra is not None:
+            self.cooldown(st, ra)
+
+
+key_scheduler = KeyScheduler()
+
+
 async def _call_completion_with_flex(
-    client, model: str, messages: List[Dict[str, str]]
+    client, model: str, messages: List[Dict[str, str]], **kwargs
 ):
-    res = client.chat.completions.create(model=model, messages=messages)
-    if asyncio.iscoroutine(res):
-        return await res
-    return await asyncio.to_thread(lambda: res)
+    completions = client.chat.completions
+    raw = getattr(completions, "with_raw_response", None)
+    create = raw.create if raw is not None else completions.create
+    if isinstance(client, openai.AsyncOpenAI) or asyncio.iscoroutinefunction(create):
+        res = await create(model=model, messages=messages, **kwargs)
+    else:
+        res = await asyncio.to_thread(create, model=model, messages=messages, **kwargs)
+        if asyncio.iscoroutine(res):
+            res = await res
+    if raw is None:
+        return res, {}
+    hdrs = {k.lower(): v for k, v in res.headers.items()}
+    return res.parse(), hdrs
 
 
 MAX_TOKENS = 5000
@@ -757,26 +1508,479 @@ def clean_think_tags(content: str) -> str:
     return content
 
 
-async def providerRouting(request: LLMRequest):
-    provider = providers[request.provider[0]]
-    agent_use = 0
+class ProviderRoutingError(Exception):
+    def __init__(
+        self, status_code: int, error: str, detail: str, skipped_wait: float = 0.0
+    ):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.error = error
+        self.detail = detail
+        self.skipped_wait = skipped_wait
+
+    def to_response(self) -> JSONResponse:
+        return JSONResponse(
+            status_code=self.status_code,
+            content={"error": self.error, "detail": self.detail},
+        )
 
-    if request.provider[0] != "groq" and request.provider[0] != "openrouter":
+
+def provider_model_name(provider_name: str, model: str) -> str:
+    if provider_name != "groq" and provider_name != "openrouter":
         try:
-            model = request.model.split("/", 1)[1]
+            return model.split("/", 1)[1]
         except Exception:
-            model = request.model
-    else:
-        model = request.model
+            return model
+    return model
+
+
+def map_model_to_provider(
+    model: str, from_provider: str, to_provider: str
+) -> Optional[str]:
+    if from_provider == to_provider:
+        return model
+    for aliases in model_aliases:
+        if aliases.get(from_provider) == model:
+            return aliases.get(to_provider)
+    return None
 
-    modified_prompt = []
-    for item in request.prompt:
-        if isinstance(item, dict):
-            role = item.get("role")
-            content = item.get("content", "")
-        else:
-            role = getattr(item, "role", None)
-            content = getattr(item, "content", "")
+
+def resolve_provider_targets(request: LLMRequest) -> List[Dict[str, Any]]:
+    primary = request.provider[0]
+    primary_model = provider_model_name(primary, request.model)
+    targets = []
+    for provider_name in dict.fromkeys(request.provider):
+        if provider_name not in providers:
+            logging.warning("Unknown provider %r in fallback chain", provider_name)
+            continue
+        model = map_model_to_provider(primary_model, primary, provider_name)
+        if model is None:
+            logging.info(
+                "No %s equivalent for model %s, skipping in fallback chain",
+                provider_name,
+                primary_model,
+            )
+            continue
+        api_keys = extract_api_keys_from_provider_conf(providers[provider_name])
+        if not api_keys:
+            continue
+        targets.append(
+            {"provider_name": provider_name, "model": model, "api_keys": api_keys}
+        )
+    return targets
+
+
+def model_targets(model: str, provider_names: List[str]) -> List[Dict[str, Any]]:
+    targets = []
+    for provider_name in provider_names:
+        mapped = map_model_to_provider(model, "cerebras", provider_name)
+        api_keys = extract_api_keys_from_provider_conf(providers[provider_name])
+        if mapped and api_keys:
+            targets.append(
+                {"provider_name": provider_name, "model": mapped, "api_keys": api_keys}
+            )
+    return targets
+
+
+model_context_windows = {
+    "cerebras": {
+        "llama-3.3-70b": 65536,
+        "llama3.1-8b": 8192,
+        "qwen-3-32b": 65536,
+        "gpt-oss-120b": 65536,
+        "llama-4-scout-17b-16e-instruct": 32768,
+    },
+    "groq": {
+        "llama-3.3-70b-versatile": 131072,
+        "llama-3.1-8b-instant": 131072,
+        "qwen/qwen3-32b": 131072,
+        "openai/gpt-oss-120b": 131072,
+        "meta-llama/llama-4-scout-17b-16e-instruct": 131072,
+    },
+    "openrouter": {
+        "meta-llama/llama-3.3-70b-instruct": 131072,
+        "meta-llama/llama-3.1-8b-instruct": 131072,
+        "qwen/qwen3-32b": 40960,
+        "openai/gpt-oss-120b": 131072,
+        "meta-llama/llama-4-scout": 131072,
+    },
+}
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", "8192"))
+CONTEXT_COMPLETION_SHARE = float(os.getenv("CONTEXT_COMPLETION_SHARE", "0.25"))
+CONTEXT_MAX_MESSAGE_SHARE = float(os.getenv("CONTEXT_MAX_MESSAGE_SHARE", "0.25"))
+CONTEXT_MIN_MESSAGE_TOKENS = int(os.getenv("CONTEXT_MIN_MESSAGE_TOKENS", "200"))
+MESSAGE_TOKEN_OVERHEAD = 4
+CHARS_PER_TOKEN_CYRILLIC = 2.8
+CHARS_PER_TOKEN_OTHER = 1.5
+cyrillic_re = re.compile(r"[\u0400-\u04ff]")
+non_ascii_re = re.compile(r"[^\x00-\x7f]")
+
+
+def raw_token_estimate(text: str) -> int:
+    if not text:
+        return 0
+    cyrillic = len(cyrillic_re.findall(text))
+    other = len(non_ascii_re.findall(text)) - cyrillic
+    ascii_chars = len(text) - cyrillic - other
+    return max(
+        1,
+        math.ceil(
+            ascii_chars / CHARS_PER_TOKEN
+            + cyrillic / CHARS_PER_TOKEN_CYRILLIC
+            + other / CHARS_PER_TOKEN_OTHER
+        ),
+    )
+
+
+class TokenCounter:
+    def __init__(self, max_entries: int, alpha: float = 0.2):
+        self.cache = LRUCache(
+            "token_count_cache", max_entries=max_entries, max_bytes=max_entries * 64
+        )
+        self.alpha = alpha
+        self.calibration: Dict[str, float] = {}
+
+    def raw(self, message: Dict[str, Any]) -> int:
+        content = message.get("content") or ""
+        key = hashlib.blake2b(
+            content.encode("utf-8", "surrogatepass"), digest_size=16
+        ).hexdigest()
+        n = self.cache.get(key)
+        if n is None:
+            n = raw_token_estimate(content)
+            self.cache.set(key, n, 64)
+        return n + MESSAGE_TOKEN_OVERHEAD
+
+    def scale(self, model: str) -> float:
+        return self.calibration.get(model, 1.0)
+
+    def tokens(self, message: Dict[str, Any], model: str) -> int:
+        return math.ceil(self.raw(message) * self.scale(model))
+
+    def calibrate(self, model: str, estimated: int, actual: Optional[int]):
+        if not estimated or not actual:
+            return
+        ratio = max(0.5, min(2.0, actual / estimated))
+        prev = self.calibration.get(model)
+        self.calibration[model] = (
+            ratio if prev is None else prev + self.alpha * (ratio - prev)
+        )
+
+    def snapshot(self) -> Dict[str, float]:
+        return {m: round(v, 3) for m, v in self.calibration.items()}
+
+
+token_counter = TokenCounter(int(os.getenv("TOKEN_COUNT_CACHE_MAX_ENTRIES", "50000")))
+
+
+def context_window(target: Dict[str, Any]) -> int:
+    return model_context_windows.get(target["provider_name"], {}).get(
+        target["model"], DEFAULT_CONTEXT_WINDOW
+    )
+
+
+def completion_max_tokens(target: Dict[str, Any]) -> int:
+    return min(MAX_TOKENS, int(context_window(target) * CONTEXT_COMPLETION_SHARE))
+
+
+def prompt_token_budget(targets: List[Dict[str, Any]]) -> int:
+    return max(
+        CONTEXT_MIN_MESSAGE_TOKENS,
+        min(context_window(t) - completion_max_tokens(t) for t in targets),
+    )
+
+
+def trim_message(message: Dict[str, Any], budget: int, model: str) -> Dict[str, Any]:
+    content = message.get("content") or ""
+    tokens = token_counter.tokens(message, model)
+    if tokens <= budget:
+        return message
+    keep = int(len(content) * (budget - MESSAGE_TOKEN_OVERHEAD - 1) / tokens)
+    metrics.inc("context_message_trimmed")
+    return {**message, "content": content[: max(keep, 0)].rstrip() + "…"}
+
+
+def fit_context_window(
+    messages: List[Dict[str, Any]], budget: int, model: str
+) -> List[Dict[str, Any]]:
+    if not messages:
+        return messages
+    head = [messages[0]] if messages[0].get("role") == "system" else []
+    history = messages[len(head) :]
+    used = sum(token_counter.tokens(m, model) for m in head)
+    if history:
+        needed = used + token_counter.tokens(history[-1], model)
+        if needed > budget:
+            metrics.inc("context_rejected")
+            raise ProviderRoutingError(
+                413,
+                "context_length_exceeded",
+                f"prompt needs ~{needed} tokens, budget for {model} is {budget}",
+            )
+    message_cap = max(
+        CONTEXT_MIN_MESSAGE_TOKENS, int(budget * CONTEXT_MAX_MESSAGE_SHARE)
+    )
+    selected = []
+    for i, m in enumerate(reversed(history)):
+        if i > 0:
+            m = trim_message(m, message_cap, model)
+        t = token_counter.tokens(m, model)
+        remaining = budget - used
+        if t > remaining:
+            if remaining >= CONTEXT_MIN_MESSAGE_TOKENS:
+                selected.append(trim_message(m, remaining, model))
+            break
+        selected.append(m)
+        used += t
+    metrics.inc("context_messages_dropped", len(history) - len(selected))
+    return [*head, *reversed(selected)]
+
+
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+CONTEXT_SUMMARY_PROVIDERS = ["cerebras", "groq"]
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "llama3.1-8b")
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "400"))
+CONTEXT_SUMMARY_CHUNK_TOKENS = int(os.getenv("CONTEXT_SUMMARY_CHUNK_TOKENS", "3000"))
+CONTEXT_SUMMARY_WAIT = float(os.getenv("CONTEXT_SUMMARY_WAIT", "0"))
+
+summary_cache = LRUCache(
+    "summary_cache",
+    max_entries=int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "5000")),
+    max_bytes=int(os.getenv("SUMMARY_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    ttl=float(os.getenv("SUMMARY_CACHE_TTL", str(7 * 24 * 3600))),
+)
+summary_flights = SingleFlight("summary_singleflight")
+summary_tasks: set = set()
+
+
+def prefix_hashes(messages: List[Dict[str, Any]]) -> List[str]:
+    h = b""
+    out = []
+    for m in messages:
+        digest = hashlib.blake2b(
+            f"{m.get('role')}\0{m.get('content') or ''}".encode(
+                "utf-8", "surrogatepass"
+            ),
+            digest_size=16,
+        ).digest()
+        h = hashlib.blake2b(h + digest, digest_size=16).digest()
+        out.append(h.hex())
+    return out
+
+
+def cached_summary(hashes: List[str], end: int) -> tuple:
+    text = summary_cache.get(hashes[end - 1])
+    if text is not None:
+        return end, text
+    for count in range(end - 1, 0, -1):
+        if hashes[count - 1] in summary_cache:
+            text = summary_cache.get(hashes[count - 1])
+            if text is not None:
+                return count, text
+    return 0, ""
+
+
+def store_summary(hashes: List[str], count: int, text: str):
+    summary_cache.set(hashes[count - 1], text, len(text.encode("utf-8")) + 64)
+
+
+async def fold_summary(summary: str, messages: List[Dict[str, Any]]) -> str:
+    transcript = "\n".join(
+        f"{m.get('role')}: {trim_to_token_budget(m.get('content') or '', 500)}"
+        for m in messages
+    )
+    prompt = [
+        {
+            "role": "system",
+            "content": (
+                "Ты ведёшь краткое содержание диалога пользователя с ассистентом. "
+                "Дополни текущее краткое содержание новыми сообщениями. Сохраняй факты о пользователе, "
+                "его цели, принятые решения, договорённости, имена, числа и незакрытые вопросы. "
+                f"Не больше {CONTEXT_SUMMARY_MAX_TOKENS * 2 // 3} слов, без вступлений, на языке диалога."
+            ),
+        },
+        {
+            "role": "user",
+            "content": f"Текущее краткое содержание:\n{summary or '—'}\n\nНовые сообщения:\n{transcript}",
+        },
+    ]
+
+    def attempt(key_state, openai_client, model):
+        return _call_completion_with_flex(
+            openai_client,
+            model,
+            prompt,
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+            temperature=0.2,
+        )
+
+    completion = await call_with_fallback(
+        model_targets(CONTEXT_SUMMARY_MODEL, CONTEXT_SUMMARY_PROVIDERS),
+        attempt,
+        track_latency=False,
+    )
+    metrics.inc("context_summary_folds")
+    return clean_think_tags(completion.choices[0].message.content or "").strip()
+
+
+async def refresh_summary(
+    history: List[Dict[str, Any]], hashes: List[str], end: int
+) -> str:
+    count, summary = cached_summary(hashes, end)
+    while count < end:
+        chunk_end = count
+        tokens = 0
+        while chunk_end < end:
+            t = token_counter.raw(history[chunk_end])
+            if chunk_end > count and tokens + t > CONTEXT_SUMMARY_CHUNK_TOKENS:
+                break
+            tokens += t
+            chunk_end += 1
+        summary = await fold_summary(summary, history[count:chunk_end])
+        count = chunk_end
+        store_summary(hashes, count, summary)
+    return summary
+
+
+def _log_summary_failure(task: asyncio.Task):
+    summary_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        metrics.inc("context_summary_failed")
+        logging.warning("Context summary failed: %r", task.exception())
+
+
+async def summarize_dropped(
+    history: List[Dict[str, Any]], dropped: int
+) -> Optional[str]:
+    hashes = prefix_hashes(history[:dropped])
+    count, summary = cached_summary(hashes, dropped)
+    if count < dropped:
+        task = asyncio.ensure_future(
+            summary_flights.do(
+                hashes[-1], lambda: refresh_summary(history, hashes, dropped)
+            )
+        )
+        summary_tasks.add(task)
+        task.add_done_callback(_log_summary_failure)
+        if CONTEXT_SUMMARY_WAIT > 0:
+            try:
+                summary = await asyncio.wait_for(
+                    asyncio.shield(task), CONTEXT_SUMMARY_WAIT
+                )
+                count = dropped
+            except Exception:
+                pass
+    metrics.inc("context_summary_hit" if count == dropped else "context_summary_stale")
+    return summary or None
+
+
+async def with_context_summary(
+    messages: List[Dict[str, Any]],
+    selected: List[Dict[str, Any]],
+    budget: int,
+    model: str,
+) -> List[Dict[str, Any]]:
+    if not CONTEXT_SUMMARY_ENABLED or len(selected) == len(messages):
+        return selected
+    reserve = CONTEXT_SUMMARY_MAX_TOKENS + MESSAGE_TOKEN_OVERHEAD
+    try:
+        selected = fit_context_window(messages, budget - reserve, model)
+    except ProviderRoutingError:
+        return selected
+    head = 1 if messages[0].get("role") == "system" else 0
+    dropped = len(messages) - len(selected)
+    summary = await summarize_dropped(messages[head:], dropped)
+    if not summary:
+        return selected
+    summary_message = trim_message(
+        {
+            "role": "system",
+            "content": f"Краткое содержание более ранней части диалога:\n{summary}",
+        },
+        reserve,
+        model,
+    )
+    return [*selected[:head], summary_message, *selected[head:]]
+
+
+CONTEXT_MODE = os.getenv("CONTEXT_MODE", "summary")
+CONTEXT_RETRIEVAL_TOP_K = int(os.getenv("CONTEXT_RETRIEVAL_TOP_K", "6"))
+CONTEXT_RETRIEVAL_SHARE = float(os.getenv("CONTEXT_RETRIEVAL_SHARE", "0.3"))
+
+
+def retrieval_query(messages: List[Dict[str, Any]]) -> str:
+    users = [m.get("content") or "" for m in messages if m.get("role") == "user"]
+    return "\n".join(users[-2:])
+
+
+def with_retrieved_context(
+    messages: List[Dict[str, Any]],
+    selected: List[Dict[str, Any]],
+    budget: int,
+    model: str,
+) -> List[Dict[str, Any]]:
+    if len(selected) == len(messages):
+        return selected
+    reserve = int(budget * CONTEXT_RETRIEVAL_SHARE)
+    try:
+        recent = fit_context_window(messages, budget - reserve, model)
+    except ProviderRoutingError:
+        return selected
+    head = 1 if messages[0].get("role") == "system" else 0
+    older = messages[head : len(messages) - len(recent) + head]
+    started = time.perf_counter()
+    ranked = relevant_messages(
+        [m.get("content") or "" for m in older],
+        retrieval_query(recent[head:]),
+        CONTEXT_RETRIEVAL_TOP_K,
+    )
+    metrics.observe("context_retrieval_seconds", time.perf_counter() - started)
+    used = 2 * MESSAGE_TOKEN_OVERHEAD
+    picked = []
+    for i in ranked:
+        m = trim_message(older[i], max(CONTEXT_MIN_MESSAGE_TOKENS, reserve // 2), model)
+        t = token_counter.tokens(m, model)
+        if used + t > reserve:
+            continue
+        picked.append((i, m))
+        used += t
+    if not picked:
+        return selected
+    metrics.inc("context_retrieved_messages", len(picked))
+    content = "Релевантные сообщения из более ранней части диалога:\n\n" + "\n\n".join(
+        f"[{m['role']}] {m['content']}" for _, m in sorted(picked, key=lambda p: p[0])
+    )
+    return [*recent[:head], {"role": "system", "content": content}, *recent[head:]]
+
+
+async def apply_context_mode(
+    request: LLMRequest,
+    messages: List[Dict[str, Any]],
+    selected: List[Dict[str, Any]],
+    budget: int,
+    model: str,
+) -> List[Dict[str, Any]]:
+    mode = request.context_mode or CONTEXT_MODE
+    if mode == "retrieval":
+        return with_retrieved_context(messages, selected, budget, model)
+    if mode == "summary":
+        return await with_context_summary(messages, selected, budget, model)
+    return selected
+
+
+def normalize_prompt(items: list) -> List[Dict[str, str]]:
+    modified_prompt = []
+    for item in items:
+        if isinstance(item, dict):
+            role = item.get("role")
+            content = item.get("content", "")
+        else:
+            role = getattr(item, "role", None)
+            content = getattr(item, "content", "")
 
         if content is None:
             content = ""
@@ -790,11 +1994,139 @@ async def providerRouting(request: LLMRequest):
             role = "user"
 
         modified_prompt.append({"role": str(role), "content": new_content})
+    return modified_prompt
+
+
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "500"))
+
+
+class ChatSessionStore:
+    def __init__(self, max_chats: int, max_bytes: int, ttl: float):
+        self.cache = LRUCache(
+            "session_cache", max_entries=max_chats, max_bytes=max_bytes, ttl=ttl
+        )
+
+    def get(self, chat_id: str) -> Optional[List[Dict[str, str]]]:
+        return self.cache.get(chat_id)
 
-    if request.is_agent:
-        full_messages = await tool_agent_call([m.copy() for m in modified_prompt])
-        if not isinstance(full_messages, list):
+    def put(self, chat_id: str, messages: List[Dict[str, str]]):
+        if len(messages) > SESSION_MAX_MESSAGES:
+            head = [messages[0]] if messages[0].get("role") == "system" else []
+            messages = [*head, *messages[-(SESSION_MAX_MESSAGES - len(head)) :]]
+        size = sum(len(m["content"].encode("utf-8")) + 32 for m in messages)
+        self.cache.set(chat_id, messages, size)
+
+
+chat_sessions = ChatSessionStore(
+    max_chats=int(os.getenv("SESSION_MAX_CHATS", "2000")),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(128 * 1024 * 1024))),
+    ttl=float(os.getenv("SESSION_TTL", str(24 * 3600))),
+)
+
+
+def open_session(request: LLMRequest) -> Optional[Dict[str, Any]]:
+    if not request.chat_id:
+        return None
+    new_messages = normalize_prompt(request.prompt)
+    if request.history == "delta":
+        cached = chat_sessions.get(request.chat_id)
+        if cached is None:
+            metrics.inc("session_miss")
+            raise ProviderRoutingError(
+                409,
+                "session_not_found",
+                f"no cached history for chat {request.chat_id}, resend full history",
+            )
+        metrics.inc("session_delta")
+        messages = [*cached, *new_messages]
+    else:
+        metrics.inc("session_refill")
+        messages = new_messages
+    return {"chat_id": request.chat_id, "messages": messages}
+
+
+def commit_session(session: Optional[Dict[str, Any]], content: Optional[str]):
+    if not session or not content:
+        return
+    reply = {"role": "assistant", "content": clean_think_tags(content).strip()}
+    chat_sessions.put(session["chat_id"], [*session["messages"], reply])
+
+
+def merge_agent_messages(
+    history: List[Dict[str, Any]],
+    start: List[Dict[str, Any]],
+    agent_messages: List[Any],
+) -> List[Any]:
+    seen = {id(m) for m in start}
+    added = [m for m in agent_messages if id(m) not in seen]
+    head = 1 if history and history[0].get("role") == "system" else 0
+    inserted = []
+    appended = []
+    for m in added:
+        if isinstance(m, dict) and m.get("role") == "system":
+            inserted.append(m)
+        else:
+            appended.append(m)
+    return [*history[:head], *inserted, *history[head:], *appended]
+
+
+async def prepare_provider_request(request: LLMRequest) -> Dict[str, Any]:
+    agent_use = 0
+
+    session = open_session(request)
+    if session is not None:
+        modified_prompt = [m.copy() for m in session["messages"]]
+    else:
+        modified_prompt = normalize_prompt(request.prompt)
+
+    prefix = (
+        f"Сейчас {datetime.date.today().isoformat()}, это 100 процентно правильная дата, "
+        "ориентируйся на неё. Если видишь, что ответ пришёл от tool или function, то доверяй ему на 99 процентов"
+        "Если в сообщениях роли function/tool содержится результат внешнего поиска, считай эти данные актуальными и не спорь с ними"
+    )
+    modified_prompt = add_prefix_if_first_is_system(modified_prompt, prefix)
+
+    targets = resolve_provider_targets(request)
+    if not targets:
+        raise ProviderRoutingError(500, "no_api_keys", "no api keys found for provider")
+
+    token_model = targets[0]["model"]
+    budget = prompt_token_budget(targets)
+    selected_messages = fit_context_window(modified_prompt, budget, token_model)
+
+    final = None
+    agent_saved = 0
+    use_agent = request.is_agent
+    if use_agent and TOOL_CLASSIFIER_ENABLED and not needs_tools(modified_prompt):
+        metrics.inc("agent_skipped_by_classifier")
+        use_agent = False
+    if use_agent:
+        mode = resolve_agent_mode(request, targets)
+        agent_run_targets = targets if mode == "direct" else agent_targets()
+        agent_messages = selected_messages
+        if agent_run_targets and mode != "direct":
+            agent_messages = fit_context_window(
+                modified_prompt,
+                min(budget, prompt_token_budget(agent_run_targets)),
+                token_model,
+            )
+        agent_messages = [m.copy() for m in agent_messages]
+        agent = await run_agent(list(agent_messages), targets=agent_run_targets)
+        if not isinstance(agent["messages"], list):
             raise RuntimeError("tool_agent_call вернул не список сообщений")
+        full_messages = merge_agent_messages(
+            modified_prompt, agent_messages, agent["messages"]
+        )
+        if agent["final_content"] and (
+            mode == "direct" or (mode == "reuse" and agent["tool_steps"] == 0)
+        ):
+            final = {
+                "type": "text",
+                "content": agent["final_content"],
+                "usage": agent["usage"],
+            }
+            agent_saved = 1
+            metrics.inc(f"agent_final_reused.{mode}")
         full_messages = [
             (
                 {
@@ -807,147 +2139,470 @@ async def providerRouting(request: LLMRequest):
             for m in full_messages
         ]
         agent_use += 1
+        full_messages = add_prefix_if_first_is_system(full_messages, prefix)
+        selected_messages = fit_context_window(full_messages, budget, token_model)
     else:
         full_messages = modified_prompt
-
-    prefix = (
-        f"Сейчас {datetime.date.today().isoformat()}, это 100 процентно правильная дата, "
-        "ориентируйся на неё. Если видишь, что ответ пришёл от tool или function, то доверяй ему на 99 процентов"
-        "Если в сообщениях роли function/tool содержится результат внешнего поиска, считай эти данные актуальными и не спорь с ними"
+    selected_messages = await apply_context_mode(
+        request, full_messages, selected_messages, budget, token_model
     )
-    full_messages = add_prefix_if_first_is_system(full_messages, prefix)
-    selected_messages = full_messages[0]
-    selected_messages = [selected_messages, *full_messages[-6:]]
     try:
         safe_messages = sanitize_for_provider(selected_messages)
     except Exception as e:
         print("Sanitization error:", repr(e))
-        return JSONResponse(
-            status_code=500,
-            content={"error": "sanitization_error", "detail": str(e)},
-        )
+        raise ProviderRoutingError(500, "sanitization_error", str(e))
+
+    return {
+        "targets": targets,
+        "messages": safe_messages,
+        "agent_use": agent_use,
+        "agent_saved": agent_saved,
+        "final": final,
+        "token_model": token_model,
+        "session": session,
+        "prompt_tokens_raw": sum(token_counter.raw(m) for m in safe_messages),
+    }
+
+
+def agent_headers(prepared: Dict[str, Any]) -> Dict[str, str]:
+    return {
+        "Agent-Use": f"{prepared['agent_use']}",
+        "Agent-Use-Saved": f"{prepared.get('agent_saved', 0)}",
+    }
 
-    api_keys = extract_api_keys_from_provider_conf(provider)
-    if not api_keys:
-        return JSONResponse(
-            status_code=500,
-            content={
-                "error": "no_api_keys",
-                "detail": "no api keys found for provider",
-            },
-        )
 
+async def call_with_key_rotation(
+    provider_name: str, api_keys: List[str], attempt, fail_fast: bool = False
+):
     max_rounds = 20
     per_key_backoff = 0.2
     round_index = 0
+    attempts = 0
+    max_attempts = max_rounds * len(api_keys)
+    failed_keys: set = set()
     last_exception = None
 
-    while round_index < max_rounds:
-        round_index += 1
-        saw_retry_header = False
-        retry_seconds = None
-
-        for idx, api_key in enumerate(api_keys):
-            logging.debug(
-                "Trying provider %s key %d/%d (round %d)",
-                request.provider[0],
-                idx + 1,
-                len(api_keys),
-                round_index,
+    while attempts < max_attempts and round_index < max_rounds:
+        key_state = key_scheduler.acquire(provider_name, api_keys, exclude=failed_keys)
+        if key_state is None:
+            wait_time = key_scheduler.next_available_in(
+                provider_name, api_keys, exclude=failed_keys
             )
-            openai_client = openai.OpenAI(
-                base_url=provider["base_url"], api_key=api_key
-            )
-            try:
-                completion = await _call_completion_with_flex(
-                    openai_client, model, safe_messages
-                )
-
-                resp_text = (
-                    completion.choices[0].message.content
-                    if getattr(completion, "choices", None)
-                    else ""
+            if fail_fast:
+                raise ProviderRoutingError(
+                    503,
+                    "provider_exhausted",
+                    f"all {provider_name} keys are cooling down or failing",
+                    skipped_wait=(
+                        wait_time
+                        if wait_time is not None
+                        else min(2 ** min(round_index + 1, 6), 60)
+                    ),
                 )
-                return JSONResponse(
-                    content={
-                        "type": "text",
-                        "content": resp_text,
-                        "usage": {
-                            "prompt_tokens": completion.usage.prompt_tokens,
-                            "completion_tokens": completion.usage.completion_tokens,
-                        },
-                    },
-                    headers={"Agent-Use": f"{agent_use}"},
+            if wait_time is not None:
+                wait_time = min(wait_time + 0.05, KEY_MAX_COOLDOWN)
+                logging.info(
+                    "All keys of %s are cooling down, waiting %.2fs for the earliest reset",
+                    provider_name,
+                    wait_time,
                 )
+                await asyncio.sleep(wait_time)
+                continue
+            round_index += 1
+            failed_keys.clear()
+            sleep_time = min(2 ** min(round_index, 6), 60)
+            logging.info(
+                "All keys exhausted (no retry header). Sleeping %.2fs before next round",
+                sleep_time,
+            )
+            await asyncio.sleep(sleep_time)
+            continue
 
-            except Exception as e:
-                logging.exception(
-                    "Provider call failed with key index %d: %s", idx, repr(e)
+        attempts += 1
+        idx = api_keys.index(key_state.api_key)
+        logging.debug(
+            "Trying provider %s key %d/%d (attempt %d, in flight %d)",
+            provider_name,
+            idx + 1,
+            len(api_keys),
+            attempts,
+            key_state.in_flight,
+        )
+        openai_client = client_registry.openai_client(provider_name, key_state.api_key)
+        try:
+            result, resp_headers = await attempt(key_state, openai_client)
+            key_scheduler.record_success(key_state, resp_headers)
+            return result
+
+        except Exception as e:
+            logging.exception(
+                "Provider call failed with key index %d: %s", idx, repr(e)
+            )
+            last_exception = e
+            status = detect_status_from_exception(e)
+            headers = extract_headers_from_exception(e)
+            key_scheduler.record_failure(key_state, status, headers)
+
+            if status in (429, 402) or key_state.cooling():
+                logging.info(
+                    "Key %d of %s is cooling down (status %s); rotating to next key",
+                    idx + 1,
+                    provider_name,
+                    status,
                 )
-                last_exception = e
-                status = detect_status_from_exception(e)
-                headers = extract_headers_from_exception(e)
-
-                if status in (429, 402):
-                    logging.info(
-                        "Detected status %s for key %d; rotating to next key",
-                        status,
-                        idx + 1,
+                continue
+
+            if status is not None and status >= 500:
+                if fail_fast:
+                    raise ProviderRoutingError(
+                        502,
+                        "provider_error",
+                        str(e),
+                        skipped_wait=per_key_backoff,
                     )
-                    await asyncio.sleep(per_key_backoff)
-                    continue
+                logging.info(
+                    "Transient server error %s, try next key after short sleep",
+                    status,
+                )
+                failed_keys.add(key_state.api_key)
+                await asyncio.sleep(per_key_backoff)
+                continue
 
-                parsed = parse_retry_seconds_from_headers(headers)
-                if parsed is not None:
-                    saw_retry_header = True
-                    retry_seconds = parsed
-                    logging.info(
-                        "Detected retry header, will wait %.2fs before next round",
-                        retry_seconds,
-                    )
-                    break
+            logging.error("Unrecoverable provider error: %s", repr(e))
+            raise ProviderRoutingError(500, "provider_error", str(e))
+        finally:
+            key_scheduler.release(key_state)
 
-                if status is not None and status >= 500:
-                    logging.info(
-                        "Transient server error %s, try next key after short sleep",
-                        status,
-                    )
-                    await asyncio.sleep(per_key_backoff)
-                    continue
+    logging.error("providerRouting: max_rounds reached, failing")
+    raise ProviderRoutingError(502, "provider_unavailable", str(last_exception))
+
+
+async def call_with_fallback(
+    targets: List[Dict[str, Any]], attempt, track_latency: bool = True
+):
+    last_error = None
+    for i, target in enumerate(targets):
+        is_last = i == len(targets) - 1
+        provider_name = target["provider_name"]
+        model = target["model"]
+
+        async def timed_attempt(key_state, openai_client):
+            t0 = time.perf_counter()
+            result = await attempt(key_state, openai_client, model)
+            if track_latency:
+                latency_tracker.record(provider_name, model, time.perf_counter() - t0)
+            return result
 
-                logging.error("Unrecoverable provider error: %s", repr(e))
+        try:
+            return await call_with_key_rotation(
+                provider_name,
+                target["api_keys"],
+                timed_attempt,
+                fail_fast=not is_last,
+            )
+        except ProviderRoutingError as e:
+            if is_last:
+                raise
+            last_error = e
+            next_provider = targets[i + 1]["provider_name"]
+            logging.warning(
+                "Provider %s failed (%s: %s), falling back to %s",
+                provider_name,
+                e.error,
+                e.detail,
+                next_provider,
+            )
+            metrics.inc("provider_fallback_total")
+            metrics.inc(f"provider_fallback.{provider_name}->{next_provider}")
+            metrics.observe("provider_fallback_saved_seconds", e.skipped_wait)
+    raise last_error or ProviderRoutingError(
+        500, "no_api_keys", "no api keys found for provider"
+    )
+
+
+async def call_hedged(targets: List[Dict[str, Any]], attempt):
+    primary = targets[0]
+    delay = hedge_policy.delay_for(primary["provider_name"], primary["model"])
+    decision = hedge_policy.record_request()
+
+    first = asyncio.create_task(call_with_fallback(targets, attempt))
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not hedge_policy.allow_hedge(decision):
+            return await first
+
+        logging.info(
+            "No answer from %s/%s after %.2fs, sending hedged request",
+            primary["provider_name"],
+            primary["model"],
+            delay,
+        )
+        metrics.inc("hedge_fired_total")
+        hedge = asyncio.create_task(call_with_fallback(targets, attempt))
+        tasks.add(hedge)
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for t in done:
+                if t.exception() is None:
+                    if t is hedge:
+                        metrics.inc("hedge_won_total")
+                    return t.result()
+                error = error or t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+
+
+def completion_cache_key(prepared: Dict[str, Any]) -> str:
+    return cache_key_for(
+        [(t["provider_name"], t["model"]) for t in prepared["targets"]],
+        prepared["messages"],
+    )
+
+
+def completion_payload(completion) -> Dict[str, Any]:
+    resp_text = (
+        completion.choices[0].message.content
+        if getattr(completion, "choices", None)
+        else ""
+    )
+    return {
+        "type": "text",
+        "content": resp_text,
+        "usage": {
+            "prompt_tokens": completion.usage.prompt_tokens,
+            "completion_tokens": completion.usage.completion_tokens,
+        },
+    }
+
+
+def store_completion(cache_key: Optional[str], payload: Dict[str, Any]):
+    if cache_key is None or not payload.get("content"):
+        return
+    size = len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    completion_cache.set(cache_key, payload, size)
+
+
+async def providerRouting(request: LLMRequest):
+    hedge = HEDGE_ENABLED if request.hedge is None else request.hedge
+    try:
+        prepared = await prepare_provider_request(request)
+        if prepared["final"] is not None:
+            commit_session(prepared["session"], prepared["final"]["content"])
+            return JSONResponse(
+                content=prepared["final"], headers=agent_headers(prepared)
+            )
+        request_key = completion_cache_key(prepared)
+        cache_key = request_key if request.cache else None
+        if cache_key is not None:
+            cached = completion_cache.get(cache_key)
+            if cached is not None:
+                commit_session(prepared["session"], cached["content"])
                 return JSONResponse(
-                    status_code=500,
-                    content={"error": "provider_error", "detail": str(e)},
+                    content=cached,
+                    headers={**agent_headers(prepared), "X-Cache": "HIT"},
                 )
 
-        if saw_retry_header and retry_seconds is not None:
-            wait_time = float(retry_seconds) + 0.5
-            max_wait = 300.0
-            if wait_time > max_wait:
-                wait_time = max_wait
-            logging.info(
-                "Waiting %.2fs due to rate-limit headers before retrying key pool",
-                wait_time,
+        def attempt(key_state, openai_client, model):
+            return _call_completion_with_flex(
+                openai_client, model, prepared["messages"]
             )
-            await asyncio.sleep(wait_time)
-            continue
-        else:
-            sleep_time = min(2 ** min(round_index, 6), 60)
-            logging.info(
-                "All keys exhausted (no retry header). Sleeping %.2fs before next round",
-                sleep_time,
+
+        async def fetch():
+            if hedge:
+                completion = await call_hedged(prepared["targets"], attempt)
+            else:
+                completion = await call_with_fallback(prepared["targets"], attempt)
+            payload = completion_payload(completion)
+            token_counter.calibrate(
+                prepared["token_model"],
+                prepared["prompt_tokens_raw"],
+                payload["usage"]["prompt_tokens"],
             )
-            await asyncio.sleep(sleep_time)
-            continue
+            store_completion(cache_key, payload)
+            return payload
+
+        if cache_key is None:
+            payload = await fetch()
+        else:
+            payload = await completion_flights.do(cache_key, fetch)
+    except ProviderRoutingError as e:
+        return e.to_response()
+    commit_session(prepared["session"], payload["content"])
 
-    logging.error("providerRouting: max_rounds reached, failing")
     return JSONResponse(
-        status_code=502,
-        content={"error": "provider_unavailable", "detail": str(last_exception)},
+        content=payload,
+        headers={
+            **agent_headers(prepared),
+            "X-Cache": "MISS" if cache_key is not None else "BYPASS",
+        },
+    )
+
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _next_chunk(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+def _chunk_usage(chunk) -> Optional[Dict[str, int]]:
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+    }
+
+
+def _chunk_delta(chunk) -> str:
+    choices = getattr(chunk, "choices", None)
+    if not choices:
+        return ""
+    delta = getattr(choices[0], "delta", None)
+    return (getattr(delta, "content", None) or "") if delta is not None else ""
+
+
+async def providerRoutingStream(request: LLMRequest):
+    started = time.perf_counter()
+    try:
+        prepared = await prepare_provider_request(request)
+        if prepared["final"] is not None:
+            return cached_stream_response(prepared["final"], prepared, started, None)
+        cache_key = completion_cache_key(prepared) if request.cache else None
+        cached = completion_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return cached_stream_response(cached, prepared, started, "HIT")
+
+        async def open_stream(key_state, openai_client, model):
+            stream, hdrs = await _call_completion_with_flex(
+                openai_client,
+                model,
+                prepared["messages"],
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            first = await _next_chunk(stream)
+            return (stream, first), hdrs
+
+        stream, first = await call_with_fallback(
+            prepared["targets"], open_stream, track_latency=False
+        )
+    except ProviderRoutingError as e:
+        return e.to_response()
+
+    agent_use = prepared["agent_use"]
+
+    async def events():
+        ttft = None
+        usage = None
+        parts = []
+        chunk = first
+        try:
+            while chunk is not None:
+                usage = _chunk_usage(chunk) or usage
+                delta = _chunk_delta(chunk)
+                if delta:
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    parts.append(delta)
+                    yield sse_event("delta", {"content": delta})
+                chunk = await _next_chunk(stream)
+        except Exception as e:
+            logging.exception("Provider stream failed: %s", repr(e))
+            yield sse_event("error", {"error": "provider_error", "detail": str(e)})
+            return
+        finally:
+            try:
+                await stream.close()
+            except Exception:
+                pass
+
+        commit_session(prepared["session"], "".join(parts))
+        if usage:
+            token_counter.calibrate(
+                prepared["token_model"],
+                prepared["prompt_tokens_raw"],
+                usage.get("prompt_tokens"),
+            )
+        store_completion(
+            cache_key, {"type": "text", "content": "".join(parts), "usage": usage}
+        )
+        total = time.perf_counter() - started
+        logging.info(
+            "Stream finished: ttft %.3fs, total %.3fs",
+            ttft if ttft is not None else total,
+            total,
+        )
+        yield sse_event(
+            "done",
+            {
+                "type": "text",
+                "usage": usage,
+                "agent_use": agent_use,
+                "ttft_ms": round((ttft if ttft is not None else total) * 1000, 1),
+                "total_ms": round(total * 1000, 1),
+            },
+        )
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            **agent_headers(prepared),
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Cache": "MISS" if cache_key is not None else "BYPASS",
+        },
     )
 
 
+def cached_stream_response(
+    cached: Dict[str, Any],
+    prepared: Dict[str, Any],
+    started: float,
+    cache_status: Optional[str],
+) -> StreamingResponse:
+    agent_use = prepared["agent_use"]
+    headers = {
+        **agent_headers(prepared),
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    }
+    if cache_status:
+        headers["X-Cache"] = cache_status
+
+    async def events():
+        commit_session(prepared["session"], cached["content"])
+        yield sse_event("delta", {"content": cached["content"]})
+        total_ms = round((time.perf_counter() - started) * 1000, 1)
+        yield sse_event(
+            "done",
+            {
+                "type": "text",
+                "usage": cached.get("usage"),
+                "agent_use": agent_use,
+                "ttft_ms": total_ms,
+                "total_ms": total_ms,
+            },
+        )
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
 def sanitize_for_provider(messages: List[Dict]) -> List[Dict]:
 
     out = []
@@ -1093,7 +2748,7 @@ tools = [
         "type": "function",
         "function": {
             "name": "python_code_execution",
-            "description": "Позволяет тебе исполнить почти любой python code, используй когда нужно что-то проверить, посчитать очень большие числа, где важна точность, ТОЛЬКО ОТ СЧЁТА НА МИЛЛЛИАРДЫ или посмотреть выполняется ли python код ли  правильно",
+            "description": "Позволяет тебе исполнить почти любой python code, используй когда нужно что-то проверить, посчитать очень большие числа, где важна точность, ТОЛЬКО ОТ СЧЁТА НА МИЛЛЛИАРДЫ или посмотреть выполняется ли python код ли  правильно. Код исполняется локально без доступа к сети и файлам, только стандартная библиотека; результат выводи через print или последним выражением",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -1147,7 +2802,7 @@ tools = [
 
 
 async def web_search(query: str):
-    response = groqClient.chat.completions.create(
+    response = await groqClient.chat.completions.create(
         model="compound-beta",
         messages=[
             {
@@ -1206,79 +2861,697 @@ async def web_search(query: str):
     return top3_text
 
 
+SANDBOX_WORKER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py"
+)
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "2"))
+SANDBOX_MAX_CONCURRENCY = int(os.getenv("SANDBOX_MAX_CONCURRENCY", "4"))
+SANDBOX_TIMEOUT = float(os.getenv("SANDBOX_TIMEOUT", "10"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "256"))
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "5"))
+SANDBOX_MAX_OUTPUT = int(os.getenv("SANDBOX_MAX_OUTPUT", "10000"))
+SANDBOX_USER = os.getenv("SANDBOX_USER", "nobody")
+SANDBOX_PYTHON = os.getenv("SANDBOX_PYTHON", sys.executable)
+
+
+class PythonSandboxPool:
+    def __init__(self, size: int, max_concurrency: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self._idle: deque = deque()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._refills: set = set()
+        self._spawning = 0
+        self._closed = False
+        self._prefix: List[str] = []
+        self._owner: Optional[tuple] = None
+        with open(SANDBOX_WORKER, encoding="utf-8") as f:
+            self._worker_source = f.read()
+
+    def _env(self, workdir: str) -> Dict[str, str]:
+        return {
+            "PATH": "/usr/local/bin:/usr/bin:/bin",
+            "HOME": workdir,
+            "TMPDIR": workdir,
+            "LANG": "C.UTF-8",
+            "PYTHONIOENCODING": "utf-8",
+            "PYTHONDONTWRITEBYTECODE": "1",
+            "SANDBOX_MEMORY_MB": str(SANDBOX_MEMORY_MB),
+            "SANDBOX_CPU_SECONDS": str(SANDBOX_CPU_SECONDS),
+            "SANDBOX_MAX_OUTPUT": str(SANDBOX_MAX_OUTPUT),
+        }
+
+    async def _isolation(self):
+        if os.geteuid() != 0:
+            logger.warning(
+                "python-песочница запущена от пользователя сервиса: "
+                "нет отдельного uid и сетевого namespace"
+            )
+            return [], None
+        if not shutil.which("setpriv"):
+            logger.warning("setpriv не найден, python-песочница запущена от root")
+            return [], None
+        try:
+            user = pwd.getpwnam(SANDBOX_USER)
+        except KeyError:
+            logger.warning("Пользователь песочницы %s не найден", SANDBOX_USER)
+            return [], None
+        owner = (user.pw_uid, user.pw_gid)
+        prefix = [
+            "setpriv",
+            f"--reuid={user.pw_uid}",
+            f"--regid={user.pw_gid}",
+            "--clear-groups",
+            "--no-new-privs",
+        ]
+        if shutil.which("unshare"):
+            probe = await asyncio.create_subprocess_exec(
+                "unshare",
+                "--net",
+                "--ipc",
+                "true",
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            if await probe.wait() == 0:
+                return ["unshare", "--net", "--ipc", "--"] + prefix, owner
+        logger.warning("Сетевой namespace недоступен, сеть песочницы не изолирована")
+        return prefix, owner
+
+    async def _spawn(self):
+        workdir = tempfile.mkdtemp(prefix="pysandbox-")
+        try:
+            if self._owner:
+                os.chown(workdir, *self._owner)
+            proc = await asyncio.create_subprocess_exec(
+                *self._prefix,
+                SANDBOX_PYTHON,
+                "-I",
+                "-S",
+                "-c",
+                self._worker_source,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=workdir,
+                env=self._env(workdir),
+                start_new_session=True,
+            )
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        metrics.inc("sandbox_spawned")
+        return proc, workdir
+
+    async def _refill(self):
+        while not self._closed and len(self._idle) + self._spawning < self.size:
+            self._spawning += 1
+            try:
+                spawned = await self._spawn()
+            except Exception as e:
+                logger.warning("Не удалось запустить python-песочницу: %s", e)
+                return
+            finally:
+                self._spawning -= 1
+            if self._closed:
+                await self._kill(*spawned)
+                return
+            self._idle.append(spawned)
+
+    def _schedule_refill(self):
+        task = asyncio.create_task(self._refill())
+        self._refills.add(task)
+        task.add_done_callback(self._refills.discard)
+
+    async def start(self):
+        self._closed = False
+        self._prefix, self._owner = await self._isolation()
+        await self._refill()
+
+    async def close(self):
+        self._closed = True
+        refills = list(self._refills)
+        for task in refills:
+            task.cancel()
+        await asyncio.gather(*refills, return_exceptions=True)
+        while self._idle:
+            proc, workdir = self._idle.popleft()
+            await self._kill(proc, workdir)
+
+    async def _kill(self, proc, workdir: str):
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    async def run(self, code: str) -> Dict[str, Any]:
+        async with self._semaphore:
+            if self._idle:
+                proc, workdir = self._idle.popleft()
+                metrics.inc("sandbox_warm")
+            else:
+                proc, workdir = await self._spawn()
+                metrics.inc("sandbox_cold")
+            self._schedule_refill()
+            started = time.perf_counter()
+            payload = json.dumps({"code": code}, ensure_ascii=False).encode("utf-8")
+            try:
+                out, err = await asyncio.wait_for(
+                    proc.communicate(payload), timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                metrics.inc("sandbox_timeout")
+                return {
+                    "stdout": "",
+                    "stderr": "",
+                    "result": None,
+                    "error": f"Превышен лимит времени {self.timeout:g}s",
+                }
+            finally:
+                await self._kill(proc, workdir)
+                metrics.observe("sandbox_run_seconds", time.perf_counter() - started)
+            try:
+                return json.loads(out.decode("utf-8", errors="replace"))
+            except json.JSONDecodeError:
+                returncode = proc.returncode
+                reason = (
+                    "превышен лимит CPU"
+                    if returncode in (-9, -24)
+                    else f"процесс завершился с кодом {returncode}"
+                )
+                return {
+                    "stdout": out.decode("utf-8", errors="replace")[
+                        :SANDBOX_MAX_OUTPUT
+                    ],
+                    "stderr": err.decode("utf-8", errors="replace")[
+                        -SANDBOX_MAX_OUTPUT:
+                    ],
+                    "result": None,
+                    "error": reason,
+                }
+
+
+python_sandbox = PythonSandboxPool(
+    SANDBOX_POOL_SIZE, SANDBOX_MAX_CONCURRENCY, SANDBOX_TIMEOUT
+)
+
+
 async def python_code_execution(code: str):
-    response = groqClient.chat.completions.create(
-        model="compound-beta",
-        messages=[
-            {
-                "role": "user",
-                "content": f"Исполни данный далее тебе Python код и напиши, что он вывел: {code}",
-            }
-        ],
-    )
-    return response.choices[0].message.content
+    return await python_sandbox.run(code)
 
 
 async def science_search(query: str):
     url = f"https://api.wolframalpha.com/v2/query?appid=TV3TVAVWAR&input={query}&output=JSON"
     timeout = httpx.Timeout(connect=60.0, read=120.0, write=60.0, pool=5.0)
 
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        resp = await client.get(url)
-        text = resp.text
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=text)
-        try:
-            return resp.json()
-        except json.JSONDecodeError:
-            raise HTTPException(
-                status_code=502, detail=f"Invalid JSON from Wolfram: {text[:200]}..."
-            )
+    client = client_registry.http("wolfram")
+    resp = await client.get(url, timeout=timeout)
+    text = resp.text
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=text)
+    try:
+        return resp.json()
+    except json.JSONDecodeError:
+        raise HTTPException(
+            status_code=502, detail=f"Invalid JSON from Wolfram: {text[:200]}..."
+        )
+
+
+async def ocr_tool(imageBase64: str):
+    return await ocr_query(OcrRequest(imageBase64=imageBase64))
+
+
+async def files_tool(buffer: str, name: str, mime: str = ""):
+    return await files_recognize(FileRequest(buffer=buffer, name=name, mime=mime))
+
+
+tool_cache_policies = {
+    "science_search": {"ttl": 7 * 24 * 3600, "normalize": "text"},
+    "ocr_tool": {"ttl": 7 * 24 * 3600, "normalize": "exact"},
+    "files_tool": {"ttl": 24 * 3600, "normalize": "exact"},
+    "web_search": {"ttl": 300, "normalize": "text"},
+}
+
+tool_result_cache = LRUCache(
+    "tool_cache",
+    max_entries=int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "5000")),
+    max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+)
+
+
+def normalize_tool_args(args: Dict[str, Any], mode: str) -> Dict[str, Any]:
+    out = {}
+    for k, v in sorted(args.items()):
+        if isinstance(v, str):
+            if len(v) > 1024:
+                v = hashlib.sha256(v.encode("utf-8")).hexdigest()
+            elif mode == "text":
+                v = " ".join(v.lower().split())
+        out[k] = v
+    return out
+
+
+def cacheable_tool_output(output: Any) -> bool:
+    if not isinstance(output, dict):
+        return True
+    if output.get("error"):
+        return False
+    result = output.get("queryresult")
+    if isinstance(result, dict) and (
+        result.get("error") or result.get("success") is False
+    ):
+        return False
+    return True
+
+
+def cached_tool(name: str, fn):
+    policy = tool_cache_policies.get(name)
+    if policy is None:
+        return fn
+
+    @functools.wraps(fn)
+    async def wrapper(**kwargs):
+        key = cache_key_for(
+            "tool", name, normalize_tool_args(kwargs, policy["normalize"])
+        )
+        hit = tool_result_cache.get(key)
+        if hit is not None:
+            metrics.inc(f"tool_cache_hit.{name}")
+            return hit
+        metrics.inc(f"tool_cache_miss.{name}")
+        output = await fn(**kwargs)
+        if not cacheable_tool_output(output):
+            metrics.inc(f"tool_cache_skipped_error.{name}")
+            return output
+        size = len(json.dumps(output, ensure_ascii=False, default=str).encode("utf-8"))
+        tool_result_cache.set(key, output, size, ttl=policy["ttl"])
+        return output
+
+    return wrapper
 
 
 available_functions = {
-    "ocr_tool": ocr_query,
-    "files_tool": files_recognize,
-    "web_search": web_search,
-    "science_search": science_search,
-    "add_memory": add_memory,
-    "search_memory": search_memory,
-    "python_code_execution": python_code_execution,
+    name: cached_tool(name, fn)
+    for name, fn in {
+        "ocr_tool": ocr_tool,
+        "files_tool": files_tool,
+        "web_search": web_search,
+        "science_search": science_search,
+        "add_memory": add_memory,
+        "search_memory": search_memory,
+        "python_code_execution": python_code_execution,
+    }.items()
+}
+
+
+AGENT_PROVIDERS = ["cerebras", "groq"]
+AGENT_MODEL = "qwen-3-32b"
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "6"))
+AGENT_TIME_BUDGET = float(os.getenv("AGENT_TIME_BUDGET", "60"))
+AGENT_TOKEN_BUDGET = int(os.getenv("AGENT_TOKEN_BUDGET", "40000"))
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "20"))
+tool_timeouts = {
+    "science_search": 30.0,
+    "python_code_execution": SANDBOX_TIMEOUT + 5,
+    "files_tool": 60.0,
+    "ocr_tool": 60.0,
+}
+
+
+AGENT_MODE = os.getenv("AGENT_MODE", "auto")
+TOOL_CLASSIFIER_ENABLED = os.getenv("TOOL_CLASSIFIER_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+
+def resolve_agent_mode(request: LLMRequest, targets: List[Dict[str, Any]]) -> str:
+    mode = request.agent_mode or AGENT_MODE
+    if mode != "auto":
+        return mode
+    primary = targets[0]
+    same_model = (
+        map_model_to_provider(AGENT_MODEL, "cerebras", primary["provider_name"])
+        == primary["model"]
+    )
+    return "direct" if same_model else "separate"
+
+
+MEMORY_PREFETCH_ENABLED = os.getenv("MEMORY_PREFETCH", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+MEMORY_PREFETCH_INJECT = os.getenv("MEMORY_PREFETCH_INJECT", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+MEMORY_PREFETCH_SIMILARITY = float(os.getenv("MEMORY_PREFETCH_SIMILARITY", "0.5"))
+word_re = re.compile(r"\w+", re.UNICODE)
+
+
+def query_stems(text: str) -> set:
+    return {w[:5] for w in word_re.findall(text.lower()) if len(w) > 2}
+
+
+def query_similarity(a: str, b: str) -> float:
+    sa, sb = query_stems(a), query_stems(b)
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / min(len(sa), len(sb))
+
+
+class MemoryPrefetch:
+    def __init__(self, query: str, user_id: str):
+        self.query = query
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.used = False
+        self.task = asyncio.create_task(self._run(user_id))
+        metrics.inc("memory_prefetch_started")
+
+    async def _run(self, user_id: str):
+        try:
+            return await search_memory(self.query, user_id=user_id)
+        finally:
+            self.duration = time.perf_counter() - self.started
+
+    def usable_for(self, query: str) -> bool:
+        if self.task.cancelled():
+            return False
+        if self.task.done() and self.task.exception() is not None:
+            return False
+        return query_similarity(self.query, query) >= MEMORY_PREFETCH_SIMILARITY
+
+    async def take(self):
+        asked_at = time.perf_counter()
+        result = await self.task
+        self.used = True
+        saved = (self.duration or 0.0) - (time.perf_counter() - asked_at)
+        metrics.inc("memory_prefetch_hit")
+        metrics.observe("memory_prefetch_saved_seconds", max(saved, 0.0))
+        return result
+
+    def result_if_ready(self):
+        if self.task.done() and not self.task.cancelled() and not self.task.exception():
+            return self.task.result()
+        return None
+
+    def close(self):
+        if not self.used:
+            metrics.inc("memory_prefetch_unused")
+        if not self.task.done():
+            self.task.cancel()
+        elif not self.task.cancelled():
+            self.task.exception()
+
+
+def start_memory_prefetch(messages: List[dict]) -> Optional[MemoryPrefetch]:
+    uid = current_user_id.get()
+    query = last_user_text(messages)
+    if not MEMORY_PREFETCH_ENABLED or not uid or uid == "system" or not query:
+        return None
+    return MemoryPrefetch(query, uid)
+
+
+def agent_targets() -> List[Dict[str, Any]]:
+    return model_targets(AGENT_MODEL, AGENT_PROVIDERS)
+
+
+TOOL_OUTPUT_TOKEN_BUDGET = int(os.getenv("TOOL_OUTPUT_TOKEN_BUDGET", "800"))
+tool_output_budgets = {
+    "science_search": 600,
+    "web_search": 600,
+    "ocr_tool": 600,
+    "search_memory": 300,
+    "files_tool": 1000,
 }
 
 
+def tool_output_text(output: Any) -> str:
+    if isinstance(output, str):
+        return output
+    if isinstance(output, list) and all(isinstance(x, str) for x in output):
+        return "\n".join(output)
+    return json.dumps(output, ensure_ascii=False, default=str)
+
+
+def reduce_wolfram_output(output: Any) -> str:
+    qr = output.get("queryresult", output) if isinstance(output, dict) else None
+    if not isinstance(qr, dict):
+        return tool_output_text(output)
+
+    lines = []
+    pods = sorted(qr.get("pods") or [], key=lambda p: not p.get("primary"))
+    for pod in pods:
+        title = pod.get("title", "")
+        subpods = pod.get("subpods") or []
+        texts = [
+            sp["plaintext"].strip()
+            for sp in subpods
+            if (sp.get("plaintext") or "").strip()
+        ]
+        if texts:
+            lines.append(f"{title}: " + "; ".join(texts))
+            continue
+        for sp in subpods:
+            src = (sp.get("img") or {}).get("src")
+            if src:
+                lines.append(f"{title}: ![{src}]")
+                break
+
+    assumptions = qr.get("assumptions") or []
+    if isinstance(assumptions, dict):
+        assumptions = [assumptions]
+    for a in assumptions[:3]:
+        values = a.get("values") or []
+        if isinstance(values, dict):
+            values = [values]
+        options = " | ".join(
+            f"{v.get('desc', v.get('name', ''))} (assumption={v.get('input', '')})"
+            for v in values[:5]
+        )
+        if options:
+            lines.append(f"Assumption '{a.get('word', a.get('type', ''))}': {options}")
+
+    if not lines:
+        if qr.get("success") is False:
+            tips = qr.get("didyoumeans") or qr.get("tips") or ""
+            return "Wolfram|Alpha не понял запрос. " + tool_output_text(tips)
+        return tool_output_text(output)
+    return "\n".join(lines)
+
+
+def reduce_files_output(output: Any) -> str:
+    if isinstance(output, dict) and "content" in output:
+        return str(output.get("content") or "")
+    return tool_output_text(output)
+
+
+def reduce_memory_output(output: Any) -> str:
+    if isinstance(output, dict) and isinstance(output.get("matches"), list):
+        memories = [
+            m.get("memory", "") if isinstance(m, dict) else str(m)
+            for m in output["matches"]
+        ]
+        return "\n".join(f"- {m}" for m in memories if m) or "Ничего не найдено"
+    return tool_output_text(output)
+
+
+tool_output_reducers = {
+    "science_search": reduce_wolfram_output,
+    "files_tool": reduce_files_output,
+    "search_memory": reduce_memory_output,
+}
+
+
+def trim_to_token_budget(text: str, budget: int) -> str:
+    if estimate_tokens_from_text(text) <= budget:
+        return text
+    return text[: budget * CHARS_PER_TOKEN].rstrip() + "…"
+
+
+def reduce_tool_output(fname: str, output: Any) -> str:
+    if isinstance(output, dict) and set(output) == {"error"}:
+        return tool_output_text(output)
+    reducer = tool_output_reducers.get(fname, tool_output_text)
+    try:
+        text = reducer(output)
+    except Exception:
+        logging.exception("Tool output reducer for %s failed", fname)
+        text = tool_output_text(output)
+    budget = tool_output_budgets.get(fname, TOOL_OUTPUT_TOKEN_BUDGET)
+    reduced = trim_to_token_budget(text, budget)
+    metrics.observe(
+        f"tool_output_tokens_raw.{fname}",
+        estimate_tokens_from_text(json.dumps(output, default=str)),
+    )
+    metrics.observe(
+        f"tool_output_tokens_reduced.{fname}", estimate_tokens_from_text(reduced)
+    )
+    return reduced
+
+
+class UnknownToolError(Exception):
+    pass
+
+
+async def run_tool_call(
+    call, memory_prefetch: Optional[MemoryPrefetch] = None
+) -> Dict[str, Any]:
+    fname = call.function.name
+    timeout = tool_timeouts.get(fname, TOOL_TIMEOUT)
+    try:
+        if fname not in available_functions:
+            raise UnknownToolError(fname)
+        args_dict = json.loads(call.function.arguments or "{}")
+        if (
+            fname == "search_memory"
+            and memory_prefetch is not None
+            and not memory_prefetch.used
+            and memory_prefetch.usable_for(str(args_dict.get("query", "")))
+        ):
+            output = await asyncio.wait_for(memory_prefetch.take(), timeout=timeout)
+        else:
+            output = await asyncio.wait_for(
+                available_functions[fname](**args_dict), timeout=timeout
+            )
+    except UnknownToolError:
+        logging.warning("Agent requested unknown tool %r", fname)
+        metrics.inc("agent_unknown_tool")
+        output = {
+            "error": f"unknown tool {fname!r}, available: "
+            + ", ".join(available_functions)
+        }
+    except asyncio.TimeoutError:
+        logging.warning("Tool %s timed out after %.1fs", fname, timeout)
+        metrics.inc(f"agent_tool_timeout.{fname}")
+        output = {"error": f"tool {fname} timed out after {timeout:g}s"}
+    except Exception as e:
+        logging.exception("Tool %s failed: %s", fname, repr(e))
+        metrics.inc(f"agent_tool_error.{fname}")
+        output = {"error": f"tool {fname} failed: {e}"}
+    return {
+        "role": "tool",
+        "tool_call_id": call.id,
+        "name": fname,
+        "content": reduce_tool_output(fname, output),
+    }
+
+
 async def tool_agent_call(start_messages: ChatMessage):
+    return (await run_agent(start_messages))["messages"]
+
+
+async def run_agent(
+    start_messages: List[dict], targets: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
     messages: List[dict] = start_messages
+    result = {
+        "messages": messages,
+        "final_content": None,
+        "tool_steps": 0,
+        "tokens_used": 0,
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+    }
+    targets = targets or agent_targets()
+    if not targets:
+        logging.error("No api keys for the agent model, skipping tools")
+        return result
 
-    while True:
-        resp = client.chat.completions.create(
-            model="qwen-3-32b",
-            messages=messages,
+    started = time.perf_counter()
+    memory_prefetch = start_memory_prefetch(messages)
+    try:
+        await _agent_steps(messages, targets, result, memory_prefetch)
+    finally:
+        if memory_prefetch is not None:
+            memories = memory_prefetch.result_if_ready()
+            if (
+                MEMORY_PREFETCH_INJECT
+                and not memory_prefetch.used
+                and memories
+                and memories.get("matches")
+            ):
+                messages.insert(
+                    1 if messages and messages[0].get("role") == "system" else 0,
+                    {
+                        "role": "system",
+                        "content": "Воспоминания о пользователе: "
+                        + json.dumps(memories["matches"], ensure_ascii=False),
+                    },
+                )
+            memory_prefetch.close()
+
+    metrics.observe("agent_seconds", time.perf_counter() - started)
+    metrics.observe("agent_tokens", result["tokens_used"])
+    return result
+
+
+async def _agent_steps(
+    messages: List[dict],
+    targets: List[Dict[str, Any]],
+    result: Dict[str, Any],
+    memory_prefetch: Optional[MemoryPrefetch],
+):
+    started = time.perf_counter()
+
+    def attempt(key_state, openai_client, model):
+        return _call_completion_with_flex(
+            openai_client,
+            model,
+            messages,
             tools=tools,
             tool_choice="auto",
+            parallel_tool_calls=True,
             temperature=0.1,
         )
-        msg = resp.choices[0].message
-        if not msg.tool_calls:
+
+    for step in range(AGENT_MAX_STEPS):
+        remaining = AGENT_TIME_BUDGET - (time.perf_counter() - started)
+        if remaining <= 0:
+            metrics.inc("agent_budget_exhausted.time")
+            break
+        if result["tokens_used"] >= AGENT_TOKEN_BUDGET:
+            metrics.inc("agent_budget_exhausted.tokens")
             break
 
-        messages.append(msg.model_dump())
+        try:
+            resp = await asyncio.wait_for(
+                call_with_fallback(targets, attempt), timeout=remaining
+            )
+        except asyncio.TimeoutError:
+            logging.warning("Agent step %d hit the time budget", step + 1)
+            metrics.inc("agent_budget_exhausted.time")
+            break
+        except ProviderRoutingError as e:
+            logging.warning("Agent step %d failed: %s", step + 1, e.detail)
+            metrics.inc("agent_provider_error")
+            break
 
-        call = msg.tool_calls[0]
-        fname = call.function.name
+        usage = getattr(resp, "usage", None)
+        result["tokens_used"] += getattr(usage, "total_tokens", 0) or 0
+        for k in ("prompt_tokens", "completion_tokens"):
+            result["usage"][k] += getattr(usage, k, 0) or 0
 
-        if fname not in available_functions:
-            raise ValueError(f"Unknown tool requested: {fname!r}")
+        msg = resp.choices[0].message
+        if not msg.tool_calls:
+            result["final_content"] = clean_think_tags(msg.content or "").strip()
+            break
 
-        args_dict = json.loads(call.function.arguments)
-        output = await available_functions[fname](**args_dict)
+        result["tool_steps"] += 1
+        messages.append(msg.model_dump(exclude_none=True))
 
-        messages.append(
-            {
-                "role": "tool",
-                "tool_call_id": call.id,
-                "name": fname,
-                "content": json.dumps(output),
-            }
+        if len(msg.tool_calls) > 1:
+            metrics.inc("agent_parallel_tool_steps")
+        metrics.inc("agent_tool_calls", len(msg.tool_calls))
+        outputs = await asyncio.gather(
+            *(run_tool_call(call, memory_prefetch) for call in msg.tool_calls)
         )
-    return messages
\ No newline at end of file
+        messages.extend(outputs)
+    else:
+        metrics.inc("agent_budget_exhausted.steps")
\ No newline at end of file
@@ -0,0 +1,201 @@
+import ast
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import traceback
+
+# Preloaded while the worker waits in the pool, so user imports of them are instant.
+import collections  # noqa: F401
+import datetime  # noqa: F401
+import decimal  # noqa: F401
+import fractions  # noqa: F401
+import itertools  # noqa: F401
+import math  # noqa: F401
+import random  # noqa: F401
+import re  # noqa: F401
+import statistics  # noqa: F401
+
+MAX_OUTPUT_CHARS = int(os.environ.get("SANDBOX_MAX_OUTPUT", "10000"))
+MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", "256"))
+CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", "5"))
+
+blocked_events = (
+    "socket.",
+    "subprocess.",
+    "os.system",
+    "os.exec",
+    "os.fork",
+    "os.forkpty",
+    "os.posix_spawn",
+    "os.spawn",
+    "os.kill",
+    "os.killpg",
+    "os.setuid",
+    "os.chmod",
+    "os.chown",
+    "ctypes.",
+    "pty.",
+    "urllib.",
+    "http.",
+    "ftplib.",
+    "smtplib.",
+    "webbrowser.",
+)
+
+blocked_modules = {
+    "_posixsubprocess",
+    "subprocess",
+    "multiprocessing",
+    "_multiprocessing",
+    "ctypes",
+    "_ctypes",
+    "posix",
+    "pty",
+    "socket",
+    "_socket",
+}
+
+process_primitives = (
+    "fork",
+    "forkpty",
+    "vfork",
+    "register_at_fork",
+    "execv",
+    "execve",
+    "fexecve",
+    "posix_spawn",
+    "posix_spawnp",
+    "spawnv",
+    "spawnve",
+    "system",
+    "popen",
+    "kill",
+    "killpg",
+    "pidfd_open",
+    "setuid",
+    "setgid",
+    "setreuid",
+    "setregid",
+    "setresuid",
+    "setresgid",
+    "seteuid",
+    "setegid",
+    "setgroups",
+    "chroot",
+)
+
+
+class BlockedImportFinder:
+    def find_spec(self, name, path=None, target=None):
+        if name.partition(".")[0] in blocked_modules:
+            raise ImportError(f"модуль {name} запрещён в песочнице")
+        return None
+
+
+def block_imports():
+    for module in (os, sys.modules.get("posix")):
+        for name in process_primitives:
+            if hasattr(module, name):
+                delattr(module, name)
+    for name in list(sys.modules):
+        if name.partition(".")[0] in blocked_modules:
+            del sys.modules[name]
+    sys.meta_path.insert(0, BlockedImportFinder())
+    import _imp
+
+    for name in ("create_builtin", "create_dynamic"):
+        setattr(_imp, name, guarded_loader(getattr(_imp, name)))
+
+
+def guarded_loader(load):
+    def guarded(spec, *args):
+        if spec.name.partition(".")[0] in blocked_modules:
+            raise ImportError(f"модуль {spec.name} запрещён в песочнице")
+        return load(spec, *args)
+
+    return guarded
+
+
+def set_limits():
+    resource.setrlimit(resource.RLIMIT_CPU, (CPU_SECONDS, CPU_SECONDS + 1))
+    memory = MEMORY_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (1024 * 1024, 1024 * 1024))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (32, 32))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if os.getuid() != 0:
+        resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+
+
+def install_audit_hook(workdir: str):
+    read_roots = tuple(
+        os.path.realpath(p)
+        for p in {sys.prefix, sys.base_prefix, sys.exec_prefix, workdir}
+        | {"/usr/lib", "/usr/share/zoneinfo", "/dev/null", "/dev/urandom"}
+    )
+    write_root = os.path.realpath(workdir)
+
+    def hook(event, args):
+        if event.startswith(blocked_events):
+            raise PermissionError(f"{event} запрещено в песочнице")
+        if event == "import" and str(args[0]).partition(".")[0] in blocked_modules:
+            raise PermissionError(f"модуль {args[0]} запрещён в песочнице")
+        if event == "open" and args and isinstance(args[0], (str, bytes)):
+            path = os.path.realpath(os.fsdecode(args[0]))
+            mode = args[1] if len(args) > 1 and isinstance(args[1], str) else "r"
+            writing = any(c in mode for c in "wax+")
+            if writing and not path.startswith(write_root):
+                raise PermissionError(f"запись в {path} запрещена в песочнице")
+            if not path.startswith(read_roots):
+                raise PermissionError(f"доступ к {path} запрещён в песочнице")
+
+    sys.addaudithook(hook)
+
+
+def execute(code: str) -> dict:
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    result = None
+    error = None
+    namespace = {"__name__": "__main__"}
+    try:
+        tree = ast.parse(code, mode="exec")
+        last_expr = None
+        if tree.body and isinstance(tree.body[-1], ast.Expr):
+            last_expr = ast.Expression(tree.body.pop().value)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            exec(compile(tree, "<sandbox>", "exec"), namespace)
+            if last_expr is not None:
+                value = eval(compile(last_expr, "<sandbox>", "eval"), namespace)
+                if value is not None:
+                    result = repr(value)
+    except MemoryError:
+        error = "MemoryError: превышен лимит памяти песочницы"
+    except BaseException as e:
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        stderr.write(traceback.format_exc(limit=5))
+    return {
+        "stdout": stdout.getvalue()[:MAX_OUTPUT_CHARS],
+        "stderr": stderr.getvalue()[:MAX_OUTPUT_CHARS],
+        "result": result[:MAX_OUTPUT_CHARS] if result else result,
+        "error": error,
+    }
+
+
+def main():
+    workdir = os.getcwd()
+    out = sys.stdout
+    payload = json.loads(sys.stdin.read() or "{}")
+    set_limits()
+    block_imports()
+    install_audit_hook(workdir)
+    response = execute(payload.get("code", ""))
+    out.write(json.dumps(response, ensure_ascii=False))
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name in (
+    "CEREBRAS_API_KEY_1",
+    "CEREBRAS_API_KEY_2",
+    "CEREBRAS_API_KEY_3",
+    "GROQ_API_KEY_1",
+    "GROQ_API_KEY_2",
+    "MEM0_API_KEY",
+):
+    os.environ.setdefault(name, f"test-{name.lower()}")
+
+
+class FakeMemoryClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def search(self, *args, **kwargs):
+        return []
+
+    async def add(self, *args, **kwargs):
+        return {}
+
+
+@pytest.fixture(scope="session")
+def main():
+    import mem0
+    import sentry_sdk
+
+    mem0.AsyncMemoryClient = FakeMemoryClient
+    sentry_sdk.init = lambda *args, **kwargs: None
+    import main as app_main
+
+    return app_main
+
+
+def completion_body(text: str = "ok", model: str = "test-model") -> dict:
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+    }
+
+
+@pytest.fixture
+def mock_providers(main):
+    def install(handler):
+        async def transport(request: httpx.Request):
+            response = handler(request)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        for name in main.providers:
+            main.client_registry._http[name] = httpx.AsyncClient(
+                transport=httpx.MockTransport(transport)
+            )
+        main.client_registry._openai.clear()
+
+    yield install
+    main.client_registry._http.clear()
+    main.client_registry._openai.clear()
@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+import httpx
+
+from conftest import completion_body
+
+
+def tool_call_body(name: str, arguments: dict) -> dict:
+    body = completion_body()
+    body["choices"][0]["finish_reason"] = "tool_calls"
+    body["choices"][0]["message"] = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [
+            {
+                "id": "call_0",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(arguments)},
+            }
+        ],
+    }
+    return body
+
+
+def test_unknown_tool_becomes_tool_error(main, mock_providers):
+    def agent_model(request: httpx.Request):
+        messages = json.loads(request.content)["messages"]
+        if any(m.get("role") == "tool" for m in messages):
+            return httpx.Response(200, json=completion_body("готово"))
+        return httpx.Response(200, json=tool_call_body("no_such_tool", {"q": 1}))
+
+    mock_providers(agent_model)
+
+    result = asyncio.run(
+        main.run_agent([{"role": "user", "content": "найди в интернете погоду"}])
+    )
+
+    assert result["final_content"] == "готово"
+    tool_messages = [m for m in result["messages"] if m.get("role") == "tool"]
+    assert len(tool_messages) == 1
+    assert tool_messages[0]["tool_call_id"] == "call_0"
+    assert "unknown tool" in tool_messages[0]["content"]
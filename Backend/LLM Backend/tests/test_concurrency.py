@@ -0,0 +1,203 @@
+import asyncio
+import time
+
+import httpx
+
+from conftest import completion_body
+
+UPSTREAM_DELAY = 0.5
+CONCURRENT_CALLS = 8
+
+
+def test_concurrent_llm_calls_do_not_block_each_other(main, mock_providers):
+    async def slow_upstream(request: httpx.Request):
+        await asyncio.sleep(UPSTREAM_DELAY)
+        return httpx.Response(200, json=completion_body())
+
+    mock_providers(slow_upstream)
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+
+            def ask(text: str):
+                return client.post(
+                    "/llm",
+                    json={
+                        "prompt": [{"role": "user", "content": text}],
+                        "model": "cerebras/llama-3.3-70b",
+                        "provider": ["cerebras"],
+                        "cache": False,
+                    },
+                )
+
+            await ask("прогрев")
+            started = time.perf_counter()
+            responses = await asyncio.gather(
+                *(ask(f"вопрос {i}") for i in range(CONCURRENT_CALLS))
+            )
+            return responses, time.perf_counter() - started
+
+    responses, elapsed = asyncio.run(run())
+
+    assert [r.status_code for r in responses] == [200] * CONCURRENT_CALLS
+    assert elapsed < UPSTREAM_DELAY * 2, elapsed
+
+
+def llm_request(main, text: str, **kwargs):
+    return main.LLMRequest(
+        prompt=[{"role": "user", "content": text}],
+        model="cerebras/llama-3.3-70b",
+        provider=["cerebras"],
+        hedge=False,
+        **kwargs,
+    )
+
+
+def counting_upstream(calls: list, delay: float = UPSTREAM_DELAY):
+    async def upstream(request: httpx.Request):
+        calls.append(request)
+        await asyncio.sleep(delay)
+        return httpx.Response(200, json=completion_body(f"ответ {len(calls)}"))
+
+    return upstream
+
+
+def test_identical_concurrent_requests_share_one_upstream_call(main, mock_providers):
+    calls = []
+    mock_providers(counting_upstream(calls))
+    main.completion_cache.clear()
+
+    async def run():
+        return await asyncio.gather(
+            *(
+                main.providerRouting(llm_request(main, "одинаковый вопрос"))
+                for _ in range(CONCURRENT_CALLS)
+            )
+        )
+
+    responses = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert len({r.body for r in responses}) == 1
+    assert [r.status_code for r in responses] == [200] * CONCURRENT_CALLS
+
+
+def test_cancelled_first_caller_keeps_shared_result(main, mock_providers):
+    calls = []
+    mock_providers(counting_upstream(calls))
+    main.completion_cache.clear()
+
+    async def run():
+        first = asyncio.ensure_future(
+            main.providerRouting(llm_request(main, "вопрос с отменой"))
+        )
+        await asyncio.sleep(UPSTREAM_DELAY / 5)
+        others = [
+            asyncio.ensure_future(
+                main.providerRouting(llm_request(main, "вопрос с отменой"))
+            )
+            for _ in range(3)
+        ]
+        await asyncio.sleep(UPSTREAM_DELAY / 5)
+        first.cancel()
+        responses = await asyncio.gather(*others)
+        return first, responses
+
+    first, responses = asyncio.run(run())
+
+    assert first.cancelled()
+    assert len(calls) == 1
+    assert [r.status_code for r in responses] == [200] * 3
+    assert all(r.headers["X-Cache"] == "MISS" for r in responses)
+
+
+def test_cache_bypass_neither_fills_nor_joins(main, mock_providers):
+    calls = []
+    mock_providers(counting_upstream(calls))
+    main.completion_cache.clear()
+
+    async def run():
+        bypass = await asyncio.gather(
+            *(
+                main.providerRouting(llm_request(main, "без кеша", cache=False))
+                for _ in range(3)
+            )
+        )
+        after = await main.providerRouting(llm_request(main, "без кеша"))
+        return bypass, after
+
+    bypass, after = asyncio.run(run())
+
+    assert [r.headers["X-Cache"] for r in bypass] == ["BYPASS"] * 3
+    assert len(calls) == 4
+    assert after.headers["X-Cache"] == "MISS"
+
+
+def key_of(request: httpx.Request) -> str:
+    return request.headers["authorization"].removeprefix("Bearer ")
+
+
+def test_scheduler_prefers_key_with_most_remaining_budget(
+    main, mock_providers, monkeypatch
+):
+    monkeypatch.setattr(main, "key_scheduler", main.KeyScheduler())
+    keys = main.extract_api_keys_from_provider_conf(main.providers["cerebras"])
+    remaining = dict(zip(keys, (10, 900, 50)))
+    used = []
+
+    def upstream(request: httpx.Request):
+        key = key_of(request)
+        used.append(key)
+        return httpx.Response(
+            200,
+            json=completion_body(),
+            headers={"x-ratelimit-remaining-requests-day": str(remaining[key])},
+        )
+
+    mock_providers(upstream)
+
+    async def run():
+        for i in range(len(keys) + 3):
+            response = await main.providerRouting(
+                llm_request(main, f"бюджет {i}", cache=False)
+            )
+            assert response.status_code == 200
+
+    asyncio.run(run())
+
+    assert sorted(used[: len(keys)]) == sorted(keys)
+    assert used[len(keys) :] == [keys[1]] * 3
+
+
+def test_scheduler_skips_key_cooling_down_after_429(main, mock_providers, monkeypatch):
+    monkeypatch.setattr(main, "key_scheduler", main.KeyScheduler())
+    keys = main.extract_api_keys_from_provider_conf(main.providers["cerebras"])
+    used = []
+
+    def upstream(request: httpx.Request):
+        key = key_of(request)
+        used.append(key)
+        if key == keys[0]:
+            return httpx.Response(
+                429,
+                json={"error": {"message": "rate limited"}},
+                headers={"retry-after": "30"},
+            )
+        return httpx.Response(200, json=completion_body())
+
+    mock_providers(upstream)
+
+    async def run():
+        return [
+            await main.providerRouting(llm_request(main, f"лимит {i}", cache=False))
+            for i in range(5)
+        ]
+
+    responses = asyncio.run(run())
+
+    assert [r.status_code for r in responses] == [200] * 5
+    assert used.count(keys[0]) == 1
+    assert main.key_scheduler.state("cerebras", keys[0]).cooling()
@@ -0,0 +1,51 @@
+import asyncio
+
+import httpx
+import pytest
+
+from conftest import completion_body
+
+
+def target(provider_name: str, model: str) -> dict:
+    return {"provider_name": provider_name, "model": model, "api_keys": ["k"]}
+
+
+def test_budget_follows_each_model_window(main):
+    big = main.prompt_token_budget([target("cerebras", "llama-3.3-70b")])
+    small = main.prompt_token_budget([target("cerebras", "llama3.1-8b")])
+    chain = main.prompt_token_budget(
+        [target("cerebras", "llama3.1-8b"), target("groq", "llama-3.1-8b-instant")]
+    )
+
+    assert big == 65536 - main.MAX_TOKENS
+    assert small == 8192 - 2048
+    assert chain == small
+
+
+def test_oversized_agent_prompt_is_rejected_before_provider_calls(
+    main, mock_providers, monkeypatch
+):
+    calls = []
+
+    def upstream(request: httpx.Request):
+        calls.append(request)
+        return httpx.Response(200, json=completion_body())
+
+    mock_providers(upstream)
+    monkeypatch.setattr(main, "needs_tools", lambda messages: True)
+    request = main.LLMRequest(
+        prompt=[
+            {"role": "system", "content": "Ты помощник."},
+            {"role": "user", "content": "слово " * 40000},
+        ],
+        model="cerebras/llama3.1-8b",
+        provider=["cerebras"],
+        is_agent=True,
+        cache=False,
+    )
+
+    with pytest.raises(main.ProviderRoutingError) as e:
+        asyncio.run(main.prepare_provider_request(request))
+
+    assert e.value.status_code == 413
+    assert calls == []
@@ -0,0 +1,38 @@
+import asyncio
+
+
+def chat(topic: str, turns: int) -> list:
+    messages = [{"role": "user", "content": "Привет"}]
+    for i in range(turns):
+        messages.append({"role": "assistant", "content": f"{topic} ответ {i}"})
+        messages.append({"role": "user", "content": f"{topic} вопрос {i}"})
+    return messages
+
+
+def test_chats_with_the_same_opening_keep_their_checkpoints(main, monkeypatch):
+    folds = []
+
+    async def fake_fold(summary, messages):
+        folds.append(len(messages))
+        return summary + "".join(m["content"][:1] for m in messages)
+
+    monkeypatch.setattr(main, "fold_summary", fake_fold)
+    main.summary_cache.clear()
+    cats = chat("коты", 6)
+    dogs = chat("собаки", 6)
+
+    async def run():
+        await main.refresh_summary(cats, main.prefix_hashes(cats[:9]), 9)
+        await main.refresh_summary(dogs, main.prefix_hashes(dogs[:9]), 9)
+
+    asyncio.run(run())
+    folded = len(folds)
+
+    assert main.cached_summary(main.prefix_hashes(cats[:11]), 11)[0] == 9
+    assert main.cached_summary(main.prefix_hashes(dogs[:11]), 11)[0] == 9
+    cats_summary = main.cached_summary(main.prefix_hashes(cats[:9]), 9)[1]
+    dogs_summary = main.cached_summary(main.prefix_hashes(dogs[:9]), 9)[1]
+    assert cats_summary != dogs_summary
+
+    asyncio.run(main.refresh_summary(cats, main.prefix_hashes(cats[:11]), 11))
+    assert folds[folded:] == [2]
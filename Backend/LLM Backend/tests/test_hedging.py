@@ -0,0 +1,19 @@
+def test_hedge_cap_counts_each_request_once(main):
+    policy = main.HedgePolicy(max_rate=0.5)
+    decisions = [policy.record_request() for _ in range(4)]
+
+    allowed = [policy.allow_hedge(d) for d in decisions]
+
+    assert allowed == [True, True, False, False]
+    assert [d[0] for d in decisions] == [True, True, False, False]
+
+
+def test_hedge_marks_the_hedged_request(main):
+    policy = main.HedgePolicy(max_rate=1.0)
+    first = policy.record_request()
+    second = policy.record_request()
+
+    assert policy.allow_hedge(first)
+
+    assert first == [True]
+    assert second == [False]
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+worker = os.path.join(os.path.dirname(os.path.dirname(__file__)), "sandbox_worker.py")
+
+
+def run_worker(code: str) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.run(
+            [sys.executable, "-I", "-S", worker],
+            input=json.dumps({"code": code}).encode(),
+            capture_output=True,
+            cwd=workdir,
+            env={"PATH": "/usr/bin:/bin"},
+            timeout=30,
+        )
+    return json.loads(proc.stdout)
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "import _posixsubprocess",
+        "import posix",
+        "import ctypes",
+        "import subprocess",
+        "import sys; sys.meta_path.pop(0); import _posixsubprocess",
+        "import sys; b = sys.modules['_frozen_importlib']; "
+        "b._imp.create_builtin(b.ModuleSpec('_posixsubprocess', None))",
+    ],
+)
+def test_process_modules_are_blocked(code):
+    assert "запрещ" in run_worker(code)["error"]
+
+
+def test_process_primitives_are_removed():
+    result = run_worker(
+        "import os; m = os.getpid.__self__; "
+        "[n for n in ('fork', 'execv', 'posix_spawn', 'system') "
+        "if hasattr(os, n) or hasattr(m, n)]"
+    )
+    assert result["result"] == "[]"
+
+
+def test_plain_code_runs():
+    assert run_worker("import math; math.factorial(5)")["result"] == "120"
+
+
+def test_concurrent_runs_do_not_overfill_the_pool(main):
+    pool = main.PythonSandboxPool(size=1, max_concurrency=4, timeout=30)
+
+    async def run():
+        results = await asyncio.gather(*(pool.run("1 + 1") for _ in range(4)))
+        while pool._refills:
+            await asyncio.gather(*pool._refills)
+        idle = len(pool._idle)
+        await pool.close()
+        return results, idle
+
+    results, idle = asyncio.run(run())
+
+    assert [r["result"] for r in results] == ["2"] * 4
+    assert idle == 1
+    assert not pool._idle
+
+
+def test_close_cleans_up_spawns_in_flight(main):
+    pool = main.PythonSandboxPool(size=2, max_concurrency=1, timeout=30)
+    spawned = []
+    spawn = pool._spawn
+
+    async def recording_spawn():
+        proc, workdir = await spawn()
+        spawned.append((proc, workdir))
+        return proc, workdir
+
+    pool._spawn = recording_spawn
+
+    async def run():
+        pool._schedule_refill()
+        await asyncio.sleep(0)
+        await pool.close()
+
+    asyncio.run(run())
+
+    assert not pool._idle and not pool._refills
+    for proc, workdir in spawned:
+        assert proc.returncode is not None
+        assert not os.path.exists(workdir)
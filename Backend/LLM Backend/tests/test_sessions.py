@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+from conftest import completion_body
+
+
+def session_request(main, chat_id: str, prompt: list, history: str = "full"):
+    return main.LLMRequest(
+        prompt=prompt,
+        model="cerebras/llama-3.3-70b",
+        provider=["cerebras"],
+        hedge=False,
+        cache=False,
+        chat_id=chat_id,
+        history=history,
+    )
+
+
+def recording_upstream(sent: list):
+    def upstream(request: httpx.Request):
+        messages = json.loads(request.content)["messages"]
+        sent.append([(m["role"], m["content"]) for m in messages])
+        return httpx.Response(200, json=completion_body(f"ответ {len(sent)}"))
+
+    return upstream
+
+
+def ask(main, request):
+    return asyncio.run(main.providerRouting(request))
+
+
+def test_delta_history_extends_the_cached_session(main, mock_providers):
+    sent = []
+    mock_providers(recording_upstream(sent))
+
+    first = ask(
+        main,
+        session_request(main, "chat-delta", [{"role": "user", "content": "Привет"}]),
+    )
+    second = ask(
+        main,
+        session_request(
+            main,
+            "chat-delta",
+            [{"role": "user", "content": "Как дела?"}],
+            history="delta",
+        ),
+    )
+
+    assert first.status_code == second.status_code == 200
+    assert sent[1][-3:] == [
+        ("user", "Привет"),
+        ("assistant", "ответ 1"),
+        ("user", "Как дела?"),
+    ]
+
+
+def test_delta_for_unknown_session_is_409(main, mock_providers):
+    sent = []
+    mock_providers(recording_upstream(sent))
+
+    response = ask(
+        main,
+        session_request(
+            main, "chat-unknown", [{"role": "user", "content": "?"}], history="delta"
+        ),
+    )
+
+    assert response.status_code == 409
+    assert json.loads(response.body)["error"] == "session_not_found"
+    assert sent == []
+
+
+def test_expired_session_is_refilled_with_full_history(
+    main, mock_providers, monkeypatch
+):
+    sent = []
+    mock_providers(recording_upstream(sent))
+    monkeypatch.setattr(
+        main,
+        "chat_sessions",
+        main.ChatSessionStore(max_chats=10, max_bytes=1024 * 1024, ttl=0.05),
+    )
+    full = [{"role": "user", "content": "Привет"}]
+
+    assert ask(main, session_request(main, "chat-ttl", full)).status_code == 200
+    time.sleep(0.1)
+    expired = ask(
+        main,
+        session_request(
+            main, "chat-ttl", [{"role": "user", "content": "Ещё"}], history="delta"
+        ),
+    )
+    refill = [
+        *full,
+        {"role": "assistant", "content": "ответ 1"},
+        {"role": "user", "content": "Ещё"},
+    ]
+    refilled = ask(main, session_request(main, "chat-ttl", refill))
+    delta = ask(
+        main,
+        session_request(
+            main, "chat-ttl", [{"role": "user", "content": "И ещё"}], history="delta"
+        ),
+    )
+
+    assert expired.status_code == 409
+    assert refilled.status_code == delta.status_code == 200
+    assert sent[-1][-3:] == [
+        ("user", "Ещё"),
+        ("assistant", "ответ 2"),
+        ("user", "И ещё"),
+    ]
@@ -0,0 +1,107 @@
+import asyncio
+import json
+
+import httpx
+
+FIRST_TOKEN_DELAY = 0.2
+
+
+def chunk(content=None, usage=None) -> bytes:
+    body = {
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "test-model",
+        "choices": (
+            []
+            if content is None
+            else [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+        ),
+    }
+    if usage:
+        body["usage"] = usage
+    return b"data: " + json.dumps(body, ensure_ascii=False).encode() + b"\n\n"
+
+
+class ChunkStream(httpx.AsyncByteStream):
+    def __init__(self, parts, fail_after=None):
+        self.parts = parts
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        await asyncio.sleep(FIRST_TOKEN_DELAY)
+        for i, part in enumerate(self.parts):
+            if i == self.fail_after:
+                raise httpx.ReadError("connection reset by upstream")
+            yield part
+            await asyncio.sleep(0)
+
+
+def stream_upstream(fail_after=None):
+    parts = [
+        chunk("При"),
+        chunk("вет"),
+        chunk(usage={"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}),
+        b"data: [DONE]\n\n",
+    ]
+
+    def upstream(request: httpx.Request):
+        assert json.loads(request.content)["stream"] is True
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            stream=ChunkStream(parts, fail_after),
+        )
+
+    return upstream
+
+
+def read_events(main, text: str):
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            response = await client.post(
+                "/llm",
+                json={
+                    "prompt": [{"role": "user", "content": text}],
+                    "model": "cerebras/llama-3.3-70b",
+                    "provider": ["cerebras"],
+                    "stream": True,
+                    "cache": False,
+                    "hedge": False,
+                },
+            )
+            return response
+
+    response = asyncio.run(run())
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return response, events
+
+
+def test_stream_sends_deltas_then_done(main, mock_providers):
+    mock_providers(stream_upstream())
+
+    response, events = read_events(main, "поздоровайся")
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert [e for e, _ in events] == ["delta", "delta", "done"]
+    assert "".join(d["content"] for e, d in events if e == "delta") == "Привет"
+    done = events[-1][1]
+    assert done["usage"]["prompt_tokens"] == 10
+    assert FIRST_TOKEN_DELAY * 1000 <= done["ttft_ms"] <= done["total_ms"]
+
+
+def test_stream_reports_error_when_upstream_fails_midway(main, mock_providers):
+    mock_providers(stream_upstream(fail_after=1))
+
+    response, events = read_events(main, "оборвись")
+
+    assert response.status_code == 200
+    assert [e for e, _ in events] == ["delta", "error"]
+    assert events[0][1]["content"] == "При"
+    assert events[1][1]["error"] == "provider_error"
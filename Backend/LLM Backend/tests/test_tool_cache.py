@@ -0,0 +1,30 @@
+import asyncio
+
+
+def test_tool_errors_are_not_cached(main):
+    calls = []
+
+    async def flaky_files_tool(buffer: str, name: str, mime: str = ""):
+        calls.append(name)
+        if len(calls) == 1:
+            return {"error": "Processing failed", "detail": "pool is busy"}
+        return {"content": "текст", "type": "text"}
+
+    tool = main.cached_tool("files_tool", flaky_files_tool)
+
+    async def run():
+        first = await tool(buffer="YQ==", name="a.txt")
+        second = await tool(buffer="YQ==", name="a.txt")
+        third = await tool(buffer="YQ==", name="a.txt")
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+
+    assert "error" in first
+    assert second == third == {"content": "текст", "type": "text"}
+    assert len(calls) == 2
+
+
+def test_python_execution_is_not_cached(main):
+    wrapped = main.available_functions["python_code_execution"]
+    assert wrapped is main.python_code_execution
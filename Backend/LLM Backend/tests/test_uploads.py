@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+boundary = b"testboundary"
+
+
+def multipart_body(payload: bytes, name: bytes = b"") -> list:
+    head = (
+        b"--" + boundary + b"\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+        b"Content-Type: text/plain\r\n\r\n"
+    )
+    tail = b"\r\n"
+    if name:
+        tail += (
+            b"--" + boundary + b"\r\n"
+            b'Content-Disposition: form-data; name="name"\r\n\r\n' + name + b"\r\n"
+        )
+    tail += b"--" + boundary + b"--\r\n"
+    chunk = 64 * 1024
+    return (
+        [head]
+        + [payload[i : i + chunk] for i in range(0, len(payload), chunk)]
+        + [tail]
+    )
+
+
+def make_request(chunks: list, content_type: bytes, content_length=None):
+    pulled = []
+    headers = [(b"content-type", content_type)]
+    if content_length is not None:
+        headers.append((b"content-length", str(content_length).encode()))
+
+    async def receive():
+        pulled.append(1)
+        if len(pulled) > len(chunks):
+            return {"type": "http.disconnect"}
+        return {
+            "type": "http.request",
+            "body": chunks[len(pulled) - 1],
+            "more_body": len(pulled) < len(chunks),
+        }
+
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": headers}
+    return Request(scope, receive), pulled
+
+
+def read(main, request):
+    async def run():
+        async with main.read_upload(request) as upload:
+            return upload.filename, bytes(upload.data)
+
+    return asyncio.run(run())
+
+
+multipart_type = b"multipart/form-data; boundary=" + boundary
+
+
+def test_multipart_upload_is_parsed_while_streaming(main):
+    payload = "строка текста\n".encode() * 10000
+    request, _ = make_request(
+        multipart_body(payload, "отчёт.txt".encode()), multipart_type
+    )
+
+    filename, data = read(main, request)
+
+    assert filename == "отчёт.txt"
+    assert data == payload
+
+
+def test_oversized_content_length_is_rejected_before_reading(main, monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 1024)
+    chunks = multipart_body(b"x" * 1024 * 1024)
+    request, pulled = make_request(chunks, multipart_type, sum(map(len, chunks)))
+
+    with pytest.raises(HTTPException) as e:
+        read(main, request)
+
+    assert e.value.status_code == 413
+    assert pulled == []
+
+
+def test_chunked_multipart_stops_at_the_limit(main, monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 256 * 1024)
+    chunks = multipart_body(b"x" * 4 * 1024 * 1024)
+    request, pulled = make_request(chunks, multipart_type)
+
+    with pytest.raises(HTTPException) as e:
+        read(main, request)
+
+    assert e.value.status_code == 413
+    assert len(pulled) < len(chunks) // 4
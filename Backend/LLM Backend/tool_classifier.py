@@ -0,0 +1,117 @@
+import json
+import math
+import os
+import re
+from typing import Dict, List, Optional
+
+TOOL_CLASSIFIER_THRESHOLD = float(os.getenv("TOOL_CLASSIFIER_THRESHOLD", "0.5"))
+TOOL_CLASSIFIER_MODEL = os.getenv("TOOL_CLASSIFIER_MODEL", "")
+
+tool_rules = {
+    "web_search": (
+        0.6,
+        re.compile(
+            r"(?i)(новост|сегодня|сейчас|вчера|на этой неделе|курс\w*|погод\w*|цен[аыу]\b|стоимост|"
+            r"сколько стоит|найди|поищи|загугли|в интернете|актуальн|последн\w+ верси|вышел|выйдет|"
+            r"расписани|матч|счёт игры|результат\w* выбор|news|today|latest|current|price|weather|"
+            r"search|google|look up|release[ds]?\b|score)"
+        ),
+    ),
+    "url": (0.7, re.compile(r"(?i)(https?://|www\.)\S+")),
+    "science_search": (
+        0.6,
+        re.compile(
+            r"(?i)(интеграл|производн|уравнени|реши\b|вычисли|формул|молярн|масса|плотност|"
+            r"население|сколько (людей|человек)|расстояние до|температура кипения|integral|derivative|equation|solve|"
+            r"compute|population|how many people|wolfram|\d+\s*[\^*/]\s*\d+)"
+        ),
+    ),
+    "memory": (
+        0.8,
+        re.compile(
+            r"(?i)(запомни|помнишь|вспомни|напомни,? что я|что ты знаешь обо мне|я тебе говорил|"
+            r"remember|do you recall|what do you know about me)"
+        ),
+    ),
+    "python_code_execution": (
+        0.6,
+        re.compile(
+            r"(?i)(выполни код|запусти код|исполни|посчитай точно|миллиард\w*|run (this|the) code|"
+            r"execute|```python)"
+        ),
+    ),
+}
+
+question_re = re.compile(
+    r"(?i)(\?|^\s*(кто|что|когда|где|сколько|какой|какая|какое|какие|почему|who|what|when|where|how much|how many|which)\b)"
+)
+negative_re = re.compile(
+    r"(?i)^\s*(привет|здравствуй|добрый (день|вечер)|спасибо|ок|хорошо|hi|hello|thanks)\b[\s!.,)]*$"
+    r"|^\s*(перепиши|перефразируй|переведи|исправь|сократи|улучши|напиши (стих|рассказ|письмо)|"
+    r"rewrite|rephrase|translate|fix grammar|summarize this)\b"
+)
+token_re = re.compile(r"\w+", re.UNICODE)
+
+_model_cache: Dict[str, Optional[dict]] = {}
+
+
+def load_model(path: str) -> Optional[dict]:
+    if not path:
+        return None
+    if path not in _model_cache:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                _model_cache[path] = json.load(f)
+        except Exception:
+            _model_cache[path] = None
+    return _model_cache[path]
+
+
+def model_score(text: str, model: dict) -> float:
+    weights = model.get("weights", {})
+    z = float(model.get("bias", 0.0))
+    for tok in set(token_re.findall(text.lower())):
+        z += float(weights.get(tok, 0.0))
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+def rule_score(text: str) -> float:
+    if not text.strip():
+        return 0.0
+    score = 0.0
+    for weight, pattern in tool_rules.values():
+        if pattern.search(text):
+            score += weight
+    if question_re.search(text):
+        score += 0.3
+    if len(text) > 400:
+        score += 0.1
+    if negative_re.search(text):
+        score -= 0.5
+    return max(0.0, min(1.0, score))
+
+
+def last_user_text(messages: List[dict]) -> str:
+    for m in reversed(messages):
+        if m.get("role") == "user":
+            return m.get("content") or ""
+    return ""
+
+
+def tool_need_score(
+    messages: List[dict], model_path: str = TOOL_CLASSIFIER_MODEL
+) -> float:
+    text = last_user_text(messages)
+    score = rule_score(text)
+    model = load_model(model_path)
+    if model is not None:
+        score = max(score, model_score(text, model))
+    return score
+
+
+def needs_tools(
+    messages: List[dict],
+    threshold: float = TOOL_CLASSIFIER_THRESHOLD,
+    model_path: str = TOOL_CLASSIFIER_MODEL,
+) -> bool:
+    return tool_need_score(messages, model_path) >= threshold